@@ -5,64 +5,1062 @@ import re
 import codecs
 import json
 from PyQt4.QtCore import *
-from PyQt4.QtGui import QColor, QImage, QPixmap, QPainter
+from PyQt4.QtGui import QColor, QImage, QPixmap, QPainter, QFont, QFontMetrics, qAlpha
 import math
+import heapq
+import struct
+import zlib
 from collections import OrderedDict
-from processing.tools import dataobjects
-from distutils.dir_util import copy_tree
+import sys
+from contextlib import contextmanager
+import time
+import shutil
+import tempfile
+import traceback
+import zipfile
+import hashlib
+
+class Feedback(object):
+    """Receives progress updates from long running operations and lets
+    the caller cancel them. Subclass it and override setProgress to
+    report progress to the user.
+    """
+
+    def __init__(self):
+        self._canceled = False
+
+    def setProgress(self, percentage, text = None):
+        pass
+
+    def isCanceled(self):
+        return self._canceled
+
+    def cancel(self):
+        self._canceled = True
+
+class ExportCanceled(Exception):
+    """Raised by export functions when their Feedback object is canceled"""
+    pass
+
+# number of features processed between checks of the feedback object
+CANCEL_CHECK_INTERVAL = 1000
+
+def _checkCanceled(feedback):
+    if feedback.isCanceled():
+        raise ExportCanceled()
+
+class ExportStats(object):
+    """Records the wall and CPU time spent in each stage of an export, per
+    layer, and counters such as the number of features written, bytes out,
+    sprites rendered and cached, and style layers emitted.
+
+    Listeners added with addListener are called as each measure is taken,
+    with the kind of measure ("stage" or "counter"), its name, the name of
+    the layer it refers to (or None), and its value (a dict with "wall" and
+    "cpu" times for stages, and the amount added for counters). Layers are
+    identified by their exported name, as returned by safeName.
+
+    Stages can be nested, and the time of the inner ones is also included
+    in the outer ones: for instance, processLayer includes renderSprite.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._listeners = []
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, kind, name, layer, value):
+        for listener in self._listeners:
+            listener(kind, name, layer, value)
+
+    @contextmanager
+    def stage(self, name, layer = None):
+        wall, cpu = time.time(), sum(os.times()[:2])
+        try:
+            yield
+        finally:
+            value = {"wall": time.time() - wall, "cpu": sum(os.times()[:2]) - cpu}
+            stage = self.stages.setdefault((name, layer), {"wall": 0, "cpu": 0, "calls": 0})
+            stage["wall"] += value["wall"]
+            stage["cpu"] += value["cpu"]
+            stage["calls"] += 1
+            self._notify("stage", name, layer, value)
+
+    def count(self, name, value = 1, layer = None):
+        self.counters[(name, layer)] = self.counters.get((name, layer), 0) + value
+        self._notify("counter", name, layer, value)
+
+    def asDict(self):
+        totals = OrderedDict()
+        for (name, layer), stage in self.stages.iteritems():
+            total = totals.setdefault(name, {"wall": 0, "cpu": 0})
+            total["wall"] += stage["wall"]
+            total["cpu"] += stage["cpu"]
+        counters = OrderedDict()
+        for (name, layer), value in self.counters.iteritems():
+            counters[name] = counters.get(name, 0) + value
+        return {"stages": [dict(stage, name=name, layer=layer)
+                           for (name, layer), stage in self.stages.iteritems()],
+                "counters": [{"name": name, "layer": layer, "value": value}
+                             for (name, layer), value in self.counters.iteritems()],
+                "totals": {"stages": totals, "counters": counters}}
+
+class _NoStats(object):
+    """Used when no ExportStats object is passed, so measuring costs
+    nothing more than a method call"""
+
+    @contextmanager
+    def stage(self, name, layer = None):
+        yield
+
+    def count(self, name, value = 1, layer = None):
+        pass
+
+_NO_STATS = _NoStats()
+
+EXPORT_STATS_FILE = "export-stats.json"
+
+class FolderSink(object):
+    """Writes the exported files to a folder. File names are relative to
+    it and use '/' as separator."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name):
+        path = os.path.join(self.folder, *name.split("/"))
+        QDir().mkpath(os.path.dirname(path))
+        return path
+
+    def write(self, name, data):
+        """Writes a file and returns its size in bytes"""
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        with open(self._path(name), "wb") as f:
+            f.write(data)
+        return len(data)
+
+    def scratchPath(self, name):
+        """Returns a path where a file that has to be created by a library
+        that writes to disk (such as OGR or sqlite) can be written. The file
+        is added to the output when commit is called with the same name."""
+        return self._path(name)
+
+    def commit(self, name):
+        """Adds the file created in scratchPath(name) to the output and
+        returns its size in bytes"""
+        return os.path.getsize(self._path(name))
+
+    def discard(self, name):
+        """Removes the file created in scratchPath(name), when it is not
+        going to be added to the output"""
+        path = os.path.join(self.folder, *name.split("/"))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def writeFile(self, name, path):
+        """Moves an existing file to the output and returns its size in bytes"""
+        size = os.path.getsize(path)
+        dst = self._path(name)
+        if os.path.exists(dst):
+            os.remove(dst)
+        shutil.move(path, dst)
+        return size
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """Called instead of close when the export fails. Files already
+        written to the folder are kept."""
+        pass
+
+def _replaceFile(src, dst):
+    # os.rename does not replace existing files on Windows
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+class _ReplacingFolderSink(FolderSink):
+    """A FolderSink that writes each file to a temporary name next to it
+    and then renames it, so a client reading the folder while files are
+    written again gets either the old or the new version of a file, never
+    a partial one. Files created in scratchPath are also kept under a
+    temporary name until they are committed or rewritten."""
+
+    TEMP_SUFFIX = ".tmp"
+    SCRATCH_SUFFIX = ".scratch"
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        path = self._path(name)
+        with open(path + self.TEMP_SUFFIX, "wb") as f:
+            f.write(data)
+        _replaceFile(path + self.TEMP_SUFFIX, path)
+        self.discard(name)
+        return len(data)
+
+    def scratchPath(self, name):
+        return self._path(name) + self.SCRATCH_SUFFIX
+
+    def commit(self, name):
+        path = self._path(name)
+        _replaceFile(path + self.SCRATCH_SUFFIX, path)
+        return os.path.getsize(path)
+
+    def discard(self, name):
+        path = os.path.join(self.folder, *name.split("/")) + self.SCRATCH_SUFFIX
+        if os.path.exists(path):
+            os.remove(path)
+
+    def writeFile(self, name, path):
+        size = os.path.getsize(path)
+        dst = self._path(name)
+        shutil.move(path, dst + self.TEMP_SUFFIX)
+        _replaceFile(dst + self.TEMP_SUFFIX, dst)
+        return size
+
+def _removeSourceFiles(folder, name, source):
+    """Removes the files written by createSources for a source that is not
+    used anymore: its data file, MBTiles file or tile folder, and its
+    category codes table"""
+    paths = [_categoriesFilename(name)]
+    if isinstance(source.get("data"), basestring):
+        paths.append(source["data"])
+    if source.get("url", "").startswith("mbtiles://"):
+        paths.append(source["url"][len("mbtiles://"):])
+    for tiles in source.get("tiles", []):
+        if "://" not in tiles and tiles.endswith("/{z}/{x}/{y}.png"):
+            paths.append(tiles[:-len("/{z}/{x}/{y}.png")])
+    for path in paths:
+        path = os.path.join(folder, *path.split("/"))
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+class ZipSink(object):
+    """Writes all the exported files to a single zip archive, in one
+    sequential stream, which is faster to upload and sync than a folder
+    with many small files.
+
+    Files are written directly into the archive, except the ones created
+    by libraries that need a file on disk (OGR writes GeoJSON and sqlite
+    writes MBTiles), which are written to a scratch folder and removed as
+    soon as they are added to the archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self._scratchFolder = None
+        self._scratchFiles = {}
+
+    def _removeScratchFile(self, name):
+        path = self._scratchFiles.pop(name, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.zip.writestr(name, data)
+        self._removeScratchFile(name)
+        return len(data)
+
+    def scratchPath(self, name):
+        if self._scratchFolder is None:
+            self._scratchFolder = tempfile.mkdtemp(prefix="mapboxgl-")
+        path = os.path.join(self._scratchFolder, *name.split("/"))
+        QDir().mkpath(os.path.dirname(path))
+        self._scratchFiles[name] = path
+        return path
+
+    def commit(self, name):
+        path = self._scratchFiles[name]
+        size = os.path.getsize(path)
+        self.zip.write(path, name)
+        self._removeScratchFile(name)
+        return size
+
+    def discard(self, name):
+        self._removeScratchFile(name)
+
+    def writeFile(self, name, path):
+        self.zip.write(path, name)
+        return os.path.getsize(path)
+
+    def close(self):
+        self.zip.close()
+        if self._scratchFolder is not None:
+            shutil.rmtree(self._scratchFolder, ignore_errors=True)
+            self._scratchFolder = None
+
+    def abort(self):
+        """Closes the sink and removes the partially written archive"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+HASH_LENGTH = 12
+
+def _hashedName(name, digest):
+    base, ext = os.path.splitext(name)
+    return "%s.%s%s" % (base, digest, ext)
+
+def _fileDigest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+class _HashedNamesSink(object):
+    """Wraps an output sink so data, sprite and glyph files are named after
+    a hash of their content, and can be cached forever by clients. 'names'
+    maps the original names to the hashed ones.
+
+    Sprites and glyphs are referenced in the style by a prefix and a URL
+    template, so all sprite files share the hash of the whole sprite sheet,
+    and all glyphs are written to a 'glyphs-<hash>' folder. They are kept
+    in memory until flush is called.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.names = {}
+        self._sprites = OrderedDict()
+        self._glyphs = OrderedDict()
+        self._scratchFolder = None
+        self._scratchFiles = {}
+
+    def _removeScratchFile(self, name):
+        path = self._scratchFiles.pop(name, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self._removeScratchFile(name)
+        if name.startswith("spriteSheet"):
+            self._sprites[name] = data
+            return len(data)
+        elif name.startswith("glyphs/"):
+            self._glyphs[name] = data
+            return len(data)
+        elif name.startswith("data/"):
+            self.names[name] = _hashedName(name, hashlib.sha1(data).hexdigest()[:HASH_LENGTH])
+            return self.sink.write(self.names[name], data)
+        return self.sink.write(name, data)
+
+    def scratchPath(self, name):
+        if not name.startswith("data/"):
+            return self.sink.scratchPath(name)
+        if self._scratchFolder is None:
+            self._scratchFolder = tempfile.mkdtemp(prefix="mapboxgl-")
+        path = os.path.join(self._scratchFolder, *name.split("/"))
+        QDir().mkpath(os.path.dirname(path))
+        self._scratchFiles[name] = path
+        return path
+
+    def commit(self, name):
+        if name not in self._scratchFiles:
+            return self.sink.commit(name)
+        path = self._scratchFiles[name]
+        self.names[name] = _hashedName(name, _fileDigest(path))
+        size = self.sink.writeFile(self.names[name], path)
+        self._removeScratchFile(name)
+        return size
+
+    def discard(self, name):
+        if name in self._scratchFiles:
+            self._removeScratchFile(name)
+        else:
+            self.sink.discard(name)
+
+    def writeFile(self, name, path):
+        return self.sink.writeFile(name, path)
+
+    def _groupDigest(self, files):
+        digest = hashlib.sha1()
+        for name, data in sorted(files.iteritems()):
+            digest.update(name)
+            digest.update(data)
+        return digest.hexdigest()[:HASH_LENGTH]
+
+    def flush(self):
+        if self._sprites:
+            prefix = "spriteSheet-" + self._groupDigest(self._sprites)
+            for name, data in self._sprites.iteritems():
+                self.sink.write(prefix + name[len("spriteSheet"):], data)
+            self.names["spriteSheet"] = prefix
+            self._sprites.clear()
+        if self._glyphs:
+            folder = "glyphs-" + self._groupDigest(self._glyphs)
+            for name, data in self._glyphs.iteritems():
+                self.sink.write(folder + name[len("glyphs"):], data)
+            self.names["glyphs"] = folder
+            self._glyphs.clear()
+
+    def _removeScratchFolder(self):
+        if self._scratchFolder is not None:
+            shutil.rmtree(self._scratchFolder, ignore_errors=True)
+            self._scratchFolder = None
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+        self._removeScratchFolder()
+
+    def abort(self):
+        self._sprites.clear()
+        self._glyphs.clear()
+        self.sink.abort()
+        self._removeScratchFolder()
+
+def _applyHashedNames(obj, names):
+    """Replaces the names of the files referenced by a style with the
+    hashed names they were written with"""
+    for source in obj["sources"].itervalues():
+        if isinstance(source.get("data"), basestring):
+            source["data"] = names.get(source["data"], source["data"])
+        url = source.get("url", "")
+        if url.startswith("mbtiles://"):
+            path = url[len("mbtiles://"):]
+            source["url"] = "mbtiles://" + names.get(path, path)
+    for layer in obj["layers"]:
+        metadata = layer.get("metadata", {})
+        if "qgis:categories" in metadata:
+            metadata["qgis:categories"] = names.get(metadata["qgis:categories"],
+                                                    metadata["qgis:categories"])
+    if "sprite" in obj and "spriteSheet" in names:
+        obj["sprite"] = names["spriteSheet"]
+    if "glyphs" in names and obj["glyphs"].startswith("glyphs/"):
+        obj["glyphs"] = names["glyphs"] + obj["glyphs"][len("glyphs"):]
+
+def _outputSink(folder):
+    return folder if hasattr(folder, "write") else FolderSink(folder)
+
+def _imageData(img):
+    data = QByteArray()
+    buff = QBuffer(data)
+    buff.open(QIODevice.WriteOnly)
+    img.save(buff, "PNG")
+    buff.close()
+    return str(data)
 
 def qgisLayers():
     return [lay for lay in iface.mapCanvas().layers()
-            if lay.type() == lay.VectorLayer or lay.providerType().lower() == "wms"]
+            if lay.type() in [lay.VectorLayer, lay.RasterLayer]]
+
+def projectToMapbox(folder, includeApp = False, **kwargs):
+    return toMapbox(qgisLayers(), folder, includeApp, **kwargs)
+
+def layerToMapbox(layer, folder, includeApp = False, **kwargs):
+    return toMapbox([layer], folder, includeApp, **kwargs)
+
+def toMapbox(qgislayers, folder, includeApp = False, labelAnchors = False, localGlyphs = False,
+             encodeCategories = False, dissolve = False, rasterTiles = None, rasterExtent = None,
+             rasterTileSize = 256, tuneSources = False, inlineThreshold = None,
+             center = None, zoom = None, stats = None, saveStats = False, feedback = None,
+             hashNames = False, hilbertOrder = False, rasterTileFormat = "png"):
+    if saveStats and stats is None:
+        stats = ExportStats()
+    stats = stats or _NO_STATS
+    feedback = feedback or Feedback()
+    sink = _outputSink(folder)
+    if hashNames:
+        sink = _HashedNamesSink(sink)
+    # the sink is aborted if the export fails, so no partial zip archive
+    # or scratch folder is left behind
+    try:
+        layers, sprites = createLayers(sink, qgislayers, labelAnchors, localGlyphs, encodeCategories,
+                                       rasterTiles, stats, feedback)
+        if center is None or zoom is None:
+            canvasCenter, canvasZoom = _canvasView()
+            center = canvasCenter if center is None else center
+            zoom = canvasZoom if zoom is None else zoom
+        obj = {
+            "version": 8,
+            "name": "QGIS project",
+            "glyphs": "mapbox://fonts/mapbox/{fontstack}/{range}.pbf",
+            "layers": layers,
+            "center": center,
+            "zoom": zoom
+        }
+        codepoints = {} if localGlyphs else None
+        obj["sources"] = createSources(sink, qgislayers, labelAnchors=labelAnchors,
+                                       codepoints=codepoints, encodeCategories=encodeCategories,
+                                       dissolve=dissolve, rasterTiles=rasterTiles,
+                                       rasterExtent=rasterExtent, rasterTileSize=rasterTileSize,
+                                       tuneSources=tuneSources, inlineThreshold=inlineThreshold,
+                                       stats=stats, feedback=feedback, hilbertOrder=hilbertOrder,
+                                       rasterTileFormat=rasterTileFormat)
+        feedback.setProgress(95, "Writing style")
+        if localGlyphs:
+            with stats.stage("saveGlyphs"):
+                saveGlyphs(sink, qgislayers, codepoints)
+            obj["glyphs"] = "glyphs/{fontstack}/{range}.pbf"
+        if sprites:
+            obj["sprite"] = "spriteSheet"
+        if hashNames:
+            sink.flush()
+            _applyHashedNames(obj, sink.names)
+        with stats.stage("writeStyle"):
+            stats.count("bytesOut", sink.write("mapbox.json", json.dumps(obj)))
+        if saveStats:
+            sink.write(EXPORT_STATS_FILE, json.dumps(stats.asDict(), indent=2))
+
+        if includeApp:
+            sampleAppFolder = os.path.join(os.path.dirname(__file__), "sampleapp")
+            for root, dirs, files in os.walk(sampleAppFolder):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    name = os.path.relpath(path, sampleAppFolder).replace(os.sep, "/")
+                    with open(path, "rb") as f:
+                        sink.write(name, f.read())
+        sink.close()
+    except:
+        sink.abort()
+        raise
+    feedback.setProgress(100)
 
-def projectToMapbox(folder, includeApp = False):
-    return toMapbox(qgisLayers(), folder, includeApp)
+    return obj
 
-def layerToMapbox(layer, folder, includeApp = False):
-    return toMapbox([layer], folder, includeApp)
+def _layerSnapshot(layer):
+    """Returns a copy of a layer that can be exported from a background
+    thread while the original one is still used by QGIS. It must be called
+    in the main thread.
 
-def toMapbox(qgislayers, folder, includeApp = False):
-    layers, sprites = createLayers(folder, qgislayers)
+    Vector layers are reopened from their source with their own data
+    provider, except memory layers and layers with uncommitted edits, whose
+    features are copied. Raster layers
+    are returned as they are, since QGIS already renders them from worker
+    threads.
+    """
+    if layer.type() != layer.VectorLayer:
+        return layer
+    if layer.providerType() == "memory" or layer.isModified():
+        geomType = QGis.featureType(layer.wkbType()).replace("WKB", "")
+        snapshot = _memoryLayer(geomType, layer.crs(), layer.name())
+        snapshot.dataProvider().addAttributes(layer.pendingFields().toList())
+        snapshot.updateFields()
+        snapshot.dataProvider().addFeatures(list(layer.getFeatures()))
+        snapshot.updateExtents()
+    else:
+        snapshot = QgsVectorLayer(layer.source(), layer.name(), layer.providerType())
+        snapshot.setSubsetString(layer.subsetString())
+    _copyLayerStyle(layer, snapshot)
+    return snapshot
+
+def _memoryLayer(geomType, crs, name):
+    """Returns an empty memory layer with the passed CRS. Custom CRSs have
+    no authority id to pass in the layer URI, so the layer is created in
+    EPSG:4326 in that case, and the CRS is set afterwards"""
+    layer = QgsVectorLayer("%s?crs=%s" % (geomType, crs.authid() or "EPSG:4326"), name, "memory")
+    layer.setCrs(crs)
+    return layer
+
+def _copyLayerStyle(layer, target):
+    target.setRendererV2(layer.rendererV2().clone())
+    for key in layer.customPropertyKeys():
+        target.setCustomProperty(key, layer.customProperty(key))
+    target.setLayerTransparency(layer.layerTransparency())
+    target.setScaleBasedVisibility(layer.hasScaleBasedVisibility())
+    target.setMinimumScale(layer.minimumScale())
+    target.setMaximumScale(layer.maximumScale())
+
+def _moveFolderContents(src, dst):
+    """Moves the files and folders in 'src' to 'dst', which must be in the
+    same file system. Entries are renamed, so their content is not copied,
+    and folders that already exist in 'dst' are merged with the new ones.
+    """
+    for name in os.listdir(src):
+        srcPath = os.path.join(src, name)
+        dstPath = os.path.join(dst, name)
+        if os.path.isdir(srcPath) and os.path.isdir(dstPath):
+            _moveFolderContents(srcPath, dstPath)
+        else:
+            if os.path.isfile(dstPath):
+                os.remove(dstPath)
+            os.rename(srcPath, dstPath)
+
+class ExportThread(QThread):
+    """Exports layers to Mapbox GL in a background thread, so QGIS is not
+    blocked while the export runs.
+
+    Snapshots of the layers (and the map view, unless 'center' and 'zoom'
+    are passed) are taken when the thread is created, so it must be created
+    in the main thread. The export is written to a temporary folder inside
+    'folder', and its content is only moved to 'folder' once the export is
+    finished, so nothing is left behind if it is canceled or fails.
+
+    Progress is reported with the progressChanged signal. The export is
+    canceled when cancel() is called or when the 'feedback' object passed
+    is canceled. When the thread finishes, 'result' contains the Mapbox GL
+    style, or 'canceled' is True, or 'error' contains the error raised.
+    Other keyword arguments are passed to toMapbox.
+    """
+
+    progressChanged = pyqtSignal(int, object)
+
+    def __init__(self, qgislayers, folder, includeApp = False, feedback = None, **kwargs):
+        QThread.__init__(self)
+        self.layers = [_layerSnapshot(layer) for layer in qgislayers]
+        self.folder = folder
+        self.includeApp = includeApp
+        if kwargs.get("center") is None or kwargs.get("zoom") is None:
+            center, zoom = _canvasView()
+            kwargs["center"] = kwargs.get("center") or center
+            kwargs["zoom"] = kwargs.get("zoom") if kwargs.get("zoom") is not None else zoom
+        self.kwargs = kwargs
+        self.feedback = _ThreadFeedback(self, feedback or Feedback())
+        self.result = None
+        self.error = None
+        self.canceled = False
+
+    def cancel(self):
+        self.feedback.cancel()
+
+    def run(self):
+        tempFolder = tempfile.mkdtemp(prefix=".mapboxgl-", dir=self.folder)
+        try:
+            self.result = toMapbox(self.layers, tempFolder, self.includeApp,
+                                   feedback=self.feedback, **self.kwargs)
+            _moveFolderContents(tempFolder, self.folder)
+        except ExportCanceled:
+            self.canceled = True
+        except Exception, e:
+            self.error = traceback.format_exc()
+        finally:
+            shutil.rmtree(tempFolder, ignore_errors=True)
+
+class _ThreadFeedback(Feedback):
+
+    def __init__(self, thread, feedback):
+        Feedback.__init__(self)
+        self.thread = thread
+        self.feedback = feedback
+
+    def setProgress(self, percentage, text = None):
+        self.thread.progressChanged.emit(percentage, text)
+
+    def isCanceled(self):
+        return self._canceled or self.feedback.isCanceled()
+
+def _styleLayerOwner(styleLayer):
+    return styleLayer.get("metadata", {}).get("qgis:layer", styleLayer["source"])
+
+class ExportWatcher(QObject):
+    """Keeps an exported folder in sync with the layers it was exported
+    from, while they are edited in QGIS.
+
+    start() exports the layers and starts listening to changes in their
+    renderers and features, and to layers added to and removed from the
+    project (only if no layers were passed, so the whole project is being
+    exported). Changes are collected for 'debounce' milliseconds, and then
+    only the style layers, sprites, glyphs and data files of the changed
+    layers are written again, from snapshots of the layers processed in a
+    background thread. The synced signal is emitted after each update.
+    Files are written to temporary names and then renamed, so clients
+    reading the folder during an update never get a partial file, and the
+    files of the sources of removed layers are deleted.
+
+    Keyword arguments are the export options of toMapbox. Only folders are
+    supported as output, and 'hashNames' is not supported.
+    """
+
+    synced = pyqtSignal()
+
+    def __init__(self, folder, qgislayers = None, debounce = 500, **kwargs):
+        QObject.__init__(self)
+        if kwargs.get("hashNames") or hasattr(folder, "write"):
+            raise ValueError("Only folders without hashed file names can be kept in sync")
+        self.folder = folder
+        self.kwargs = kwargs
+        self.followProject = qgislayers is None
+        self.layers = OrderedDict((layer.id(), layer) for layer in (qgislayers or qgisLayers()))
+        self.style = None
+        self._connections = {}
+        self._styleDirty = set()
+        self._dataDirty = set()
+        self._removed = False
+        self._sprites = {}
+        self._codepoints = {}
+        self._thread = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(debounce)
+        self._timer.timeout.connect(self._sync)
+
+    def start(self):
+        self.style = toMapbox(self.layers.values(), self.folder, **self.kwargs)
+        for layer in self.layers.values():
+            self._connect(layer)
+        if self.followProject:
+            QgsMapLayerRegistry.instance().layersAdded.connect(self._layersAdded)
+            QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self._layersRemoved)
+
+    def stop(self):
+        self._timer.stop()
+        for layerId in self._connections.keys():
+            self._disconnect(layerId)
+        if self.followProject:
+            QgsMapLayerRegistry.instance().layersAdded.disconnect(self._layersAdded)
+            QgsMapLayerRegistry.instance().layersWillBeRemoved.disconnect(self._layersRemoved)
+        if self._thread is not None:
+            self._thread.wait()
+
+    def _connect(self, layer):
+        if layer.type() != layer.VectorLayer:
+            return
+        layerId = layer.id()
+        rendererData = self.kwargs.get("encodeCategories") or self.kwargs.get("dissolve")
+        def styleChanged(*args):
+            self._setDirty(layerId, self._styleDirty)
+            # category codes and dissolved geometries depend on the renderer
+            if rendererData:
+                self._setDirty(layerId, self._dataDirty)
+        dataChanged = lambda *args: self._setDirty(layerId, self._dataDirty)
+        connections = [(layer.rendererChanged, styleChanged),
+                       (layer.featureAdded, dataChanged),
+                       (layer.featureDeleted, dataChanged),
+                       (layer.geometryChanged, dataChanged),
+                       (layer.attributeValueChanged, dataChanged)]
+        for signal, slot in connections:
+            signal.connect(slot)
+        self._connections[layerId] = connections
+
+    def _disconnect(self, layerId):
+        for signal, slot in self._connections.pop(layerId, []):
+            signal.disconnect(slot)
+
+    def _setDirty(self, layerId, dirty):
+        dirty.add(layerId)
+        self._timer.start()
+
+    def _layersAdded(self, layers):
+        added = [layer for layer in layers if layer.type() in [layer.VectorLayer, layer.RasterLayer]]
+        if not added:
+            return
+        # new layers are added on top of the project, which are the first ones in the style
+        self.layers = OrderedDict([(layer.id(), layer) for layer in added] + self.layers.items())
+        for layer in added:
+            self._connect(layer)
+            self._styleDirty.add(layer.id())
+            self._dataDirty.add(layer.id())
+        self._timer.start()
+
+    def _layersRemoved(self, layerIds):
+        for layerId in layerIds:
+            if layerId in self.layers:
+                self._disconnect(layerId)
+                del self.layers[layerId]
+                self._sprites.pop(layerId, None)
+                self._codepoints.pop(layerId, None)
+                self._removed = True
+        self._timer.start()
+
+    def _sync(self):
+        if self._thread is not None:
+            # changes are synced when the running update finishes
+            return
+        styleIds = self._styleDirty & set(self.layers)
+        dataIds = self._dataDirty & set(self.layers)
+        removed = self._removed
+        self._styleDirty, self._dataDirty, self._removed = set(), set(), False
+        if not (styleIds or dataIds or removed):
+            return
+        needed = styleIds | dataIds
+        if styleIds or removed:
+            needed |= set(self.layers) - set(self._sprites)
+        if self.kwargs.get("localGlyphs") and (dataIds or removed):
+            needed |= set(self.layers) - set(self._codepoints)
+        snapshots = OrderedDict((layerId, _layerSnapshot(layer))
+                                for layerId, layer in self.layers.iteritems() if layerId in needed)
+        # the thread works on copies of the state of the watcher, since layers
+        # can be added or removed in the main thread while it runs
+        state = {"layerIds": list(self.layers),
+                 "names": set(safeName(layer.name()) for layer in self.layers.values()),
+                 "sprites": dict(self._sprites),
+                 "codepoints": dict(self._codepoints),
+                 "fonts": _labelFonts(self.layers.values()) if self.kwargs.get("localGlyphs") else {}}
+        self._thread = _SyncThread(self, snapshots, styleIds, dataIds, removed, state)
+        self._thread.finished.connect(self._syncFinished)
+        self._thread.start()
+
+    def _syncFinished(self):
+        thread, self._thread = self._thread, None
+        if thread.error is not None:
+            QgsMessageLog.logMessage("ERROR: " + thread.error, level=QgsMessageLog.CRITICAL)
+        else:
+            state = thread.args[-1]
+            # layers removed while the thread was running are not kept
+            for cache, updated in [(self._sprites, state["sprites"]),
+                                   (self._codepoints, state["codepoints"])]:
+                cache.update((layerId, value) for layerId, value in updated.iteritems()
+                             if layerId in self.layers)
+            self.synced.emit()
+        if self._styleDirty or self._dataDirty or self._removed:
+            self._timer.start()
+
+    def _update(self, snapshots, styleIds, dataIds, removed, state):
+        """Writes the changed layers. It runs in a background thread, so it
+        only uses the snapshots and the copies of the watcher state passed
+        in 'state', and updates the sprites and codepoints in it"""
+        kwargs = self.kwargs
+        localGlyphs = kwargs.get("localGlyphs", False)
+        sink = _ReplacingFolderSink(self.folder)
+        names = state["names"]
+        spritesCache = state["sprites"]
+        codepointsCache = state["codepoints"]
+        if removed:
+            self.style["layers"] = [l for l in self.style["layers"] if _styleLayerOwner(l) in names]
+        for layerId in dataIds:
+            codepoints = {} if localGlyphs else None
+            self.style["sources"].update(createSources(sink, [snapshots[layerId]],
+                                                       labelAnchors=kwargs.get("labelAnchors", False),
+                                                       codepoints=codepoints,
+                                                       encodeCategories=kwargs.get("encodeCategories", False),
+                                                       dissolve=kwargs.get("dissolve", False),
+                                                       rasterTiles=kwargs.get("rasterTiles"),
+                                                       rasterExtent=kwargs.get("rasterExtent"),
+                                                       rasterTileSize=kwargs.get("rasterTileSize", 256),
+                                                       tuneSources=kwargs.get("tuneSources", False),
+                                                       inlineThreshold=kwargs.get("inlineThreshold"),
+                                                       hilbertOrder=kwargs.get("hilbertOrder", False),
+                                                       rasterTileFormat=kwargs.get("rasterTileFormat", "png")))
+            if codepoints is not None:
+                codepointsCache[layerId] = codepoints
+        for layerId, layer in snapshots.iteritems():
+            if layerId in styleIds or layerId not in spritesCache:
+                sprites, styleLayers = processLayer(layer, kwargs.get("labelAnchors", False), localGlyphs,
+                                                    kwargs.get("encodeCategories", False),
+                                                    kwargs.get("rasterTiles"))
+                spritesCache[layerId] = sprites
+                if layerId in styleIds:
+                    self._replaceStyleLayers(safeName(layer.name()), styleLayers)
+            if localGlyphs and layerId not in codepointsCache:
+                codepoints = {}
+                if layer.type() == layer.VectorLayer and _isLabeled(layer):
+                    _collectLabelCodepoints(layer, codepoints.setdefault(_labelFontstack(layer), set()))
+                codepointsCache[layerId] = codepoints
+        if styleIds or removed:
+            allSprites = {}
+            for layerId in state["layerIds"]:
+                allSprites.update(spritesCache.get(layerId, {}))
+            saveSprites(sink, allSprites)
+            if allSprites:
+                self.style["sprite"] = "spriteSheet"
+            else:
+                self.style.pop("sprite", None)
+        if localGlyphs and (dataIds or removed):
+            allCodepoints = {}
+            for layerId in state["layerIds"]:
+                for fontstack, chars in codepointsCache.get(layerId, {}).iteritems():
+                    allCodepoints.setdefault(fontstack, set()).update(chars)
+            _writeGlyphs(sink, state["fonts"], allCodepoints)
+        # sources that are not used anymore are removed from the style, and
+        # their files once the new style, which does not reference them, is written
+        used = set(l["source"] for l in self.style["layers"])
+        unused = dict((k, v) for k, v in self.style["sources"].iteritems() if k not in used)
+        self.style["sources"] = dict((k, v) for k, v in self.style["sources"].iteritems() if k in used)
+        sink.write("mapbox.json", json.dumps(self.style))
+        for name, source in unused.iteritems():
+            _removeSourceFiles(self.folder, name, source)
+
+    def _replaceStyleLayers(self, name, styleLayers):
+        layers = self.style["layers"]
+        owned = [i for i, l in enumerate(layers) if _styleLayerOwner(l) == name]
+        index = owned[0] if owned else 0
+        layers = [l for l in layers if _styleLayerOwner(l) != name]
+        self.style["layers"] = layers[:index] + styleLayers + layers[index:]
+
+class _SyncThread(QThread):
+
+    def __init__(self, watcher, snapshots, styleIds, dataIds, removed, state):
+        QThread.__init__(self)
+        self.watcher = watcher
+        self.args = (snapshots, styleIds, dataIds, removed, state)
+        self.error = None
+
+    def run(self):
+        try:
+            self.watcher._update(*self.args)
+        except Exception, e:
+            self.error = traceback.format_exc()
+
+def _canvasView():
     extent = iface.mapCanvas().extent()
     crs = iface.mapCanvas().mapSettings().destinationCrs()
     transform = QgsCoordinateTransform(crs, QgsCoordinateReferenceSystem("EPSG:4326"))
     extent = transform.transform(extent)
     center = [(extent.xMinimum() + extent.xMaximum() ) / 2, (extent.yMinimum() + extent.yMaximum() ) / 2]
     zoom = _toZoomLevel(iface.mapCanvas().scale())
-    obj = {
-        "version": 8,
-        "name": "QGIS project",
-        "glyphs": "mapbox://fonts/mapbox/{fontstack}/{range}.pbf",
-        "sources": createSources(folder, qgislayers),
-        "layers": layers,
-        "center": center,
-        "zoom": zoom
-    }
-    if sprites:
-        obj["sprite"] = "spriteSheet"
-    with open(os.path.join(folder, "mapbox.json"), 'w') as f:
-        json.dump(obj, f)
+    return center, zoom
 
-    if includeApp:
-        sampleAppFolder = os.path.join(os.path.dirname(__file__), "sampleapp")
-        copy_tree(sampleAppFolder, folder)
+HEADLESS_VIEWPORT_WIDTH = 1024
 
-    return obj
+def _projectView(projectFile):
+    """Returns the center and zoom level of the map canvas saved in a QGIS
+    project file. The zoom level is the one that fits the canvas extent in
+    a viewport of HEADLESS_VIEWPORT_WIDTH pixels, since the scale is not
+    stored in the project.
+    """
+    from xml.etree import ElementTree
+    tree = ElementTree.parse(projectFile)
+    canvas = tree.find("mapcanvas")
+    if canvas is None or canvas.find("extent") is None:
+        return [0, 0], 0
+    extent = QgsRectangle(*[float(canvas.find("extent/" + tag).text)
+                            for tag in ["xmin", "ymin", "xmax", "ymax"]])
+    authid = canvas.find("destinationsrs/spatialrefsys/authid")
+    crs = QgsCoordinateReferenceSystem(authid.text if authid is not None else "EPSG:4326")
+    transform = QgsCoordinateTransform(crs, QgsCoordinateReferenceSystem("EPSG:4326"))
+    extent = transform.transform(extent)
+    center = [(extent.xMinimum() + extent.xMaximum() ) / 2, (extent.yMinimum() + extent.yMaximum() ) / 2]
+    if extent.width() <= 0:
+        return center, 0
+    zoom = math.log(360.0 * HEADLESS_VIEWPORT_WIDTH / (512 * extent.width()), 2)
+    return center, round(max(0, min(MAX_ZOOM, zoom)), 2)
+
+def _projectLayers():
+    root = QgsProject.instance().layerTreeRoot()
+    return [node.layer() for node in root.findLayers()
+            if node.isVisible() == Qt.Checked and node.layer() is not None
+            and node.layer().type() in [QgsMapLayer.VectorLayer, QgsMapLayer.RasterLayer]]
+
+def projectFileToMapbox(projectFile, folder, includeApp = False, center = None, zoom = None, **kwargs):
+    """Exports a QGIS project file to Mapbox GL, without using the QGIS
+    interface, so it can be run in a standalone QgsApplication.
+
+    The visible layers of the project are exported. The center and zoom of
+    the map are taken from the canvas extent saved in the project, unless
+    they are passed. Other keyword arguments are passed to toMapbox.
+    """
+    project = QgsProject.instance()
+    project.clear()
+    if not project.read(QFileInfo(projectFile)):
+        raise IOError("Could not read project file '%s': %s" % (projectFile, project.error()))
+    projectCenter, projectZoom = _projectView(projectFile)
+    center = projectCenter if center is None else center
+    zoom = projectZoom if zoom is None else zoom
+    if not hasattr(folder, "write"):
+        QDir().mkpath(folder)
+    return toMapbox(_projectLayers(), folder, includeApp, center=center, zoom=zoom, **kwargs)
+
+_qgsApplication = None
+
+def _initHeadlessQgis():
+    global _qgsApplication
+    if QCoreApplication.instance() is None:
+        _qgsApplication = QgsApplication([], False)
+        QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", "/usr"), True)
+        QgsApplication.initQgis()
+
+def _exportProjectFile(args):
+    projectFile, folder, kwargs = args
+    sink = None
+    try:
+        if folder.endswith(".zip"):
+            QDir().mkpath(os.path.dirname(folder))
+            sink = ZipSink(folder)
+        projectFileToMapbox(projectFile, sink or folder, **kwargs)
+        return projectFile, None
+    except Exception, e:
+        error = traceback.format_exc()
+        # toMapbox aborts the sink when the export fails, but not when the
+        # project cannot be read. Aborting a sink twice is harmless
+        if sink is not None:
+            sink.abort()
+        return projectFile, error
+
+def batchExport(projectFiles, outputFolder, processes = None, bundle = False, **kwargs):
+    """Exports several QGIS project files in parallel, each of them in a
+    subfolder of 'outputFolder' named after the project file, or in a zip
+    file named after it if 'bundle' is True. Each worker
+    process runs its own standalone QgsApplication, using the prefix path
+    in the QGIS_PREFIX_PATH environment variable.
+
+    Returns a dict with the project files as keys and None or the error
+    raised when exporting them as values. Keyword arguments are passed
+    to projectFileToMapbox.
+    """
+    import multiprocessing
+    extension = ".zip" if bundle else ""
+    tasks = [(path, os.path.join(outputFolder, os.path.splitext(os.path.basename(path))[0] + extension),
+              kwargs) for path in projectFiles]
+    pool = multiprocessing.Pool(processes, _initHeadlessQgis)
+    try:
+        return dict(pool.map(_exportProjectFile, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv = None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Export QGIS project files to Mapbox GL")
+    parser.add_argument("projects", nargs="+", help="QGIS project files to export")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output folder. Each project is exported to a subfolder of it")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="Number of projects to export in parallel (default: number of CPUs)")
+    parser.add_argument("--center", help="Map center as lon,lat (default: project canvas extent)")
+    parser.add_argument("--zoom", type=float, help="Map zoom level (default: project canvas extent)")
+    parser.add_argument("--include-app", action="store_true", help="Include the sample OpenLayers app")
+    parser.add_argument("--zip", action="store_true",
+                        help="Write each project to a single zip file instead of a subfolder")
+    parser.add_argument("--hash-names", action="store_true",
+                        help="Name data, sprite and glyph files after a hash of their content")
+    parser.add_argument("--hilbert-order", action="store_true",
+                        help="Write features sorted along a Hilbert curve")
+    args = parser.parse_args(argv)
+    kwargs = {"includeApp": args.include_app, "zoom": args.zoom, "hashNames": args.hash_names,
+              "hilbertOrder": args.hilbert_order}
+    if args.center:
+        kwargs["center"] = [float(v) for v in args.center.split(",")]
+    errors = 0
+    results = batchExport(args.projects, args.output, args.processes, args.zip, **kwargs)
+    for projectFile, error in sorted(results.items()):
+        if error:
+            errors += 1
+            sys.stderr.write("Error exporting '%s':\n%s\n" % (projectFile, error))
+        else:
+            print "Exported '%s'" % projectFile
+    return 1 if errors else 0
 
-def createLayers(folder, _layers):
+def createLayers(folder, _layers, labelAnchors = False, localGlyphs = False,
+                 encodeCategories = False, rasterTiles = None, stats = None, feedback = None):
+    stats = stats or _NO_STATS
+    feedback = feedback or Feedback()
     layers = []
     allSprites = {}
-    for layer in _layers:
-        sprites, style = processLayer(layer)
+    for i, layer in enumerate(_layers):
+        _checkCanceled(feedback)
+        feedback.setProgress(30 * i / len(_layers), "Converting style of layer '%s'" % layer.name())
+        with stats.stage("processLayer", safeName(layer.name())):
+            sprites, style = processLayer(layer, labelAnchors, localGlyphs, encodeCategories,
+                                          rasterTiles, stats)
+        stats.count("styleLayers", len(style), safeName(layer.name()))
         layers.extend(style)
         allSprites.update(sprites)
-    saveSprites(folder, allSprites)
+    _checkCanceled(feedback)
+    feedback.setProgress(30, "Saving sprites")
+    with stats.stage("saveSprites"):
+        saveSprites(folder, allSprites)
+    stats.count("sprites", len(allSprites))
 
     return layers, allSprites
 
 NO_ICON = "no_icon"
 
 def saveSprites(folder, sprites):
+    sink = _outputSink(folder)
     if sprites:
         height = max([s.height() for s,s2x in sprites.values()])
         width = sum([s.width() for s,s2x in sprites.values()])
@@ -102,30 +1100,69 @@ def saveSprites(folder, sprites):
             x += s.width()
         painter.end()
         painter2x.end()
-        img.save(os.path.join(folder, "spriteSheet.png"))
-        img2x.save(os.path.join(folder, "spriteSheet@2x.png"))
-        with open(os.path.join(folder, "spriteSheet.json"), 'w') as f:
-            json.dump(spritesheet, f)
-        with open(os.path.join(folder, "spriteSheet@2x.json"), 'w') as f:
-            json.dump(spritesheet2x, f)
-
-def createSources(folder, layers, precision = 6):
+        sink.write("spriteSheet.png", _imageData(img))
+        sink.write("spriteSheet@2x.png", _imageData(img2x))
+        sink.write("spriteSheet.json", json.dumps(spritesheet))
+        sink.write("spriteSheet@2x.json", json.dumps(spritesheet2x))
+
+def createSources(folder, layers, precision = 6, labelAnchors = False, codepoints = None,
+                  encodeCategories = False, dissolve = False, rasterTiles = None,
+                  rasterExtent = None, rasterTileSize = 256, tuneSources = False,
+                  inlineThreshold = None, stats = None, feedback = None, hilbertOrder = False,
+                  rasterTileFormat = "png"):
+    """Writes the data of the passed layers to the 'data' subfolder of the
+    output folder (or output sink) and returns the Mapbox GL sources that
+    use it.
+
+    If a Feedback object is passed, progress is reported to it, and
+    ExportCanceled is raised as soon as possible when it is canceled.
+
+    If a 'codepoints' dict is passed, the codepoints of the label values of
+    labelled layers are added to it while their data is written, in a set
+    for the font stack of each layer.
+
+    If 'hilbertOrder' is True, features are written in the order of the
+    centers of their bounding boxes along a Hilbert curve, so features that
+    are close are also close in the file, which compresses better.
+    """
+    stats = stats or _NO_STATS
+    feedback = feedback or Feedback()
     sources = {}
-    layersFolder = os.path.join(folder, "data")
-    QDir().mkpath(layersFolder)
+    sink = _outputSink(folder)
     reducePrecision = re.compile(r"([0-9]+\.[0-9]{%s})([0-9]+)" % precision)
     removeSpaces = lambda txt:'"'.join( it if i%2 else ''.join(it.split())
                          for i,it in enumerate(txt.split('"')))
     regexp = re.compile(r'"geometry":.*?null\}')
-    for layer in layers:
+    layerCount = len(layers)
+    for i, layer in enumerate(layers):
+        _checkCanceled(feedback)
+        feedback.setProgress(35 + 60 * i / layerCount, "Writing data of layer '%s'" % layer.name())
         layerName =  safeName(layer.name())
         if layer.type() == layer.VectorLayer:
-            path = os.path.join(layersFolder, "%s.geojson" % layerName)
-            QgsVectorFileWriter.writeAsVectorFormat(layer, path, "utf-8", layer.crs(), 'GeoJson')
-            with codecs.open(path, encoding="utf-8") as f:
-                lines = f.readlines()
-            with codecs.open(path, "w", encoding="utf-8") as f:
-                for line in lines:
+            if dissolve and layer.geometryType() in [QGis.Line, QGis.Polygon]:
+                with stats.stage("dissolve", layerName):
+                    layer = _dissolvedLayer(layer, feedback)
+            codes = _categoryCodes(layer) if encodeCategories else None
+            if codes:
+                _saveCategoryCodes(layer, codes, sink, _categoriesFilename(layerName))
+            filename = "data/%s.geojson" % layerName
+            path = sink.scratchPath(filename)
+            collectors = []
+            if tuneSources:
+                statistics = _LayerStatistics(layer)
+                collectors.append(statistics)
+            if codepoints is not None and _isLabeled(layer):
+                fontstack = _labelFontstack(layer)
+                collectors.append(_LabelCodepoints(layer, codepoints.setdefault(fontstack, set())))
+            with stats.stage("writeVectorFile", layerName):
+                _writeGeoJson(layer, path, feedback, codes, collectors)
+            with stats.stage("rewriteGeoJson", layerName):
+                with codecs.open(path, encoding="utf-8") as f:
+                    lines = f.readlines()
+                rewritten = []
+                for j, line in enumerate(lines):
+                    if j % CANCEL_CHECK_INTERVAL == 0:
+                        _checkCanceled(feedback)
                     line = reducePrecision.sub(r"\1", line)
                     line = line.strip("\n\t ")
                     line = removeSpaces(line)
@@ -136,11 +1173,45 @@ def createSources(folder, layers, precision = 6):
                         line = line.replace("[[", "[")
                         line = line.replace("]]", "]")
                     line = regexp.sub(r'"geometry":null', line)
-                    f.write(line)
-            sources[layerName] = {"type": "geojson",
-                                "data": "data/%s.geojson" % layerName
-                                }
-        else:
+                    rewritten.append(line)
+                del lines
+                if hilbertOrder:
+                    rewritten = _hilbertSorted(rewritten)
+                sources[layerName], size = _geojsonSource(sink, filename, u"".join(rewritten),
+                                                          inlineThreshold)
+            stats.count("features", layer.featureCount(), layerName)
+            stats.count("bytesOut", size, layerName)
+            if tuneSources:
+                with stats.stage("tuneSource", layerName):
+                    sources[layerName].update(_geojsonSourceOptions(layer, statistics.result()))
+            if labelAnchors and _hasLabelAnchors(layer):
+                anchorsName = _labelAnchorsSourceName(layer)
+                with stats.stage("saveLabelAnchors", layerName):
+                    sources[anchorsName], size = _geojsonSource(sink, "data/%s.geojson" % anchorsName,
+                                                                _labelAnchors(layer, precision, feedback),
+                                                                inlineThreshold)
+                stats.count("bytesOut", size, layerName)
+        elif rasterTiles is not None:
+            minzoom, maxzoom = rasterTiles
+            sources[layerName] = {"type": "raster",
+                                  "tileSize": rasterTileSize,
+                                  "minzoom": minzoom,
+                                  "maxzoom": maxzoom}
+            if rasterTileFormat == "mbtiles":
+                filename = "data/%s.mbtiles" % layerName
+                with stats.stage("saveRasterTiles", layerName):
+                    saveRasterTiles(layer, sink.scratchPath(filename), minzoom, maxzoom, rasterExtent,
+                                    rasterTileSize, feedback=feedback)
+                    stats.count("bytesOut", sink.commit(filename), layerName)
+                sources[layerName]["url"] = "mbtiles://" + filename
+            else:
+                folderName = "tiles/%s" % layerName
+                with stats.stage("saveRasterTiles", layerName):
+                    size = saveRasterTileFolder(layer, sink, folderName, minzoom, maxzoom, rasterExtent,
+                                                rasterTileSize, feedback=feedback)
+                    stats.count("bytesOut", size, layerName)
+                sources[layerName]["tiles"] = [folderName + "/{z}/{x}/{y}.png"]
+        elif layer.providerType().lower() == "wms":
             source = layer.source()
             if "3857" not in layer.crs().authid():
                 QgsMessageLog.logMessage("WMS layer '%s' uses a CRS other than EPSG:3857. "
@@ -159,12 +1230,717 @@ def createSources(folder, layers, precision = 6):
 
     return sources
 
+def _styleAttributes(layer):
+    """Returns the names of the fields used by the renderer and the labels
+    of a layer, in the order of the fields in the layer.
+    """
+    names = set()
+    renderer = layer.rendererV2()
+    if isinstance(renderer, (QgsCategorizedSymbolRendererV2, QgsGraduatedSymbolRendererV2)):
+        names.add(renderer.classAttribute())
+    if _isLabeled(layer):
+        labelField = layer.customProperty("labeling/fieldName")
+        if layer.fieldNameIndex(labelField) != -1:
+            names.add(labelField)
+        else:
+            names.update(QgsExpression(labelField).referencedColumns())
+    return [f.name() for f in layer.pendingFields() if f.name() in names]
+
+def _styleClass(renderer, value):
+    if isinstance(renderer, QgsGraduatedSymbolRendererV2):
+        for i, ran in enumerate(renderer.ranges()):
+            if ran.lowerValue() <= value <= ran.upperValue():
+                return i
+        return None
+    return value
+
+def _writeGeoJson(layer, path, feedback = None, codes = None, collectors = ()):
+    """Writes the features of a layer to a GeoJSON file, in the CRS of the
+    layer. If a Feedback object is passed, ExportCanceled is raised when it
+    is canceled, checking it every CANCEL_CHECK_INTERVAL features.
+
+    If a dict of category codes (as returned by _categoryCodes) is passed,
+    the values of the class attribute of the renderer are written as their
+    integer codes, and values without a code are written as null.
+
+    Each feature is also passed to the add() method of the 'collectors'
+    (such as _LayerStatistics or _LabelCodepoints objects) before its
+    values are encoded, so they are gathered in the same pass.
+    """
+    feedback = feedback or Feedback()
+    fields = layer.pendingFields()
+    codeIndex = -1
+    if codes:
+        codeIndex = fields.indexFromName(layer.rendererV2().classAttribute())
+    if codeIndex != -1:
+        encodedFields = QgsFields()
+        for i, field in enumerate(fields):
+            encodedFields.append(QgsField(field.name(), QVariant.Int) if i == codeIndex else field)
+        fields = encodedFields
+    writer = QgsVectorFileWriter(path, "utf-8", fields, layer.wkbType(), layer.crs(), "GeoJson")
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise IOError("Could not write '%s': %s" % (path, writer.errorMessage()))
+    try:
+        for i, feature in enumerate(layer.getFeatures()):
+            if i % CANCEL_CHECK_INTERVAL == 0:
+                _checkCanceled(feedback)
+            for collector in collectors:
+                collector.add(feature)
+            if codeIndex != -1:
+                value = feature[codeIndex]
+                if value is None or isinstance(value, QPyNullVariant):
+                    code = None
+                else:
+                    code = codes.get(value)
+                feature.setAttribute(codeIndex, code)
+            writer.addFeature(feature)
+    finally:
+        # the file is completed when the writer is deleted
+        del writer
+
+def _dissolvedLayer(layer, feedback = None):
+    """Returns a memory layer with the features of the passed layer merged
+    when they share the same rendering class and label value. Touching lines
+    are merged into longer lines, and adjacent polygons are unioned into a
+    single polygon, so each group of adjacent polygons becomes a feature.
+    Only the attributes used by the renderer and the labels are kept.
+
+    The memory layer has the name, renderer and custom properties (including
+    labeling settings) of the original one, so it can be exported instead
+    of it. If a Feedback object is passed, ExportCanceled is raised when it
+    is canceled.
+    """
+    feedback = feedback or Feedback()
+    renderer = layer.rendererV2()
+    attributes = _styleAttributes(layer)
+    classAttribute = None
+    if isinstance(renderer, (QgsCategorizedSymbolRendererV2, QgsGraduatedSymbolRendererV2)):
+        classAttribute = renderer.classAttribute()
+    groups = OrderedDict()
+    for i, feature in enumerate(layer.getFeatures()):
+        if i % CANCEL_CHECK_INTERVAL == 0:
+            _checkCanceled(feedback)
+        geom = feature.geometry()
+        if geom is None or geom.isGeosEmpty():
+            continue
+        values = [feature[name] for name in attributes]
+        key = tuple(_styleClass(renderer, v) if name == classAttribute else v
+                    for name, v in zip(attributes, values))
+        if key not in groups:
+            groups[key] = (values, [])
+        groups[key][1].append(QgsGeometry(geom))
+
+    isLine = layer.geometryType() == QGis.Line
+    dissolved = _memoryLayer("MultiLineString" if isLine else "MultiPolygon", layer.crs(), layer.name())
+    fields = [f for f in layer.pendingFields() if f.name() in attributes]
+    dissolved.dataProvider().addAttributes(fields)
+    dissolved.updateFields()
+    features = []
+    for values, geoms in groups.itervalues():
+        _checkCanceled(feedback)
+        if isLine:
+            lines = []
+            for geom in geoms:
+                lines.extend(geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()])
+            parts = [QgsGeometry.fromMultiPolyline(_mergeLines([l for l in lines if len(l) > 1]))]
+        else:
+            # polygons that do not touch are left as separate features
+            union = QgsGeometry.unaryUnion(geoms)
+            polygons = union.asMultiPolygon() if union.isMultipart() else [union.asPolygon()]
+            parts = [QgsGeometry.fromPolygon(polygon) for polygon in polygons if polygon]
+        for geom in parts:
+            feature = QgsFeature(dissolved.pendingFields())
+            feature.setGeometry(geom)
+            feature.setAttributes(values)
+            features.append(feature)
+    dissolved.dataProvider().addFeatures(features)
+    dissolved.updateExtents()
+    _copyLayerStyle(layer, dissolved)
+    return dissolved
+
+def _mergeLines(lines):
+    """Merges lines that share an end point not shared by any other line,
+    in the same way as the GEOS line merge operation does.
+    """
+    ends = {}
+    for i, line in enumerate(lines):
+        ends.setdefault((line[0].x(), line[0].y()), []).append(i)
+        ends.setdefault((line[-1].x(), line[-1].y()), []).append(i)
+    used = set()
+    merged = []
+    for i, line in enumerate(lines):
+        if i in used:
+            continue
+        used.add(i)
+        chain = list(line)
+        for forward in [True, False]:
+            while True:
+                end = chain[-1] if forward else chain[0]
+                key = (end.x(), end.y())
+                candidates = [j for j in ends[key] if j not in used]
+                if len(ends[key]) != 2 or not candidates:
+                    break
+                used.add(candidates[0])
+                other = lines[candidates[0]]
+                if (other[0].x(), other[0].y()) != key:
+                    other = other[::-1]
+                if forward:
+                    chain.extend(other[1:])
+                else:
+                    chain[0:0] = other[::-1][:-1]
+        merged.append(chain)
+    return merged
+
+HILBERT_ORDER = 16
+
+def _hilbertIndex(x, y, order = HILBERT_ORDER):
+    """Returns the position of the (x, y) cell along a Hilbert curve that
+    covers a grid of 2^order x 2^order cells"""
+    index = 0
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return index
+
+_number = re.compile(r"-?[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?")
+
+def _featureBoundsCenter(line):
+    """Returns the center of the bounding box of the geometry of a GeoJSON
+    feature written in a single line, or None if it has no geometry.
+    OGR writes the geometry after the properties, so the search starts
+    after the last "geometry" key, skipping properties with those names"""
+    start = line.rfind('"geometry":')
+    if start == -1:
+        return None
+    start = line.find('"coordinates":', start)
+    if start == -1:
+        return None
+    start = line.find("[", start)
+    depth = 0
+    for end in xrange(start, len(line)):
+        if line[end] == "[":
+            depth += 1
+        elif line[end] == "]":
+            depth -= 1
+            if depth == 0:
+                break
+    values = [float(v) for v in _number.findall(line[start:end])]
+    if len(values) < 2:
+        return None
+    xs, ys = values[0::2], values[1::2]
+    return (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2
+
+def _hilbertSorted(lines):
+    """Sorts the features of a GeoJSON file rewritten by createSources (one
+    feature per line) along a Hilbert curve over the extent of the layer.
+    Features without geometry are written last."""
+    features = [i for i, line in enumerate(lines) if line.startswith('{"type":"Feature"')]
+    if not features or features != range(features[0], features[-1] + 1):
+        return lines
+    centers = [_featureBoundsCenter(lines[i]) for i in features]
+    points = [c for c in centers if c is not None]
+    if not points:
+        return lines
+    xmin, xmax = min(p[0] for p in points), max(p[0] for p in points)
+    ymin, ymax = min(p[1] for p in points), max(p[1] for p in points)
+    cells = (1 << HILBERT_ORDER) - 1
+    width, height = (xmax - xmin) or 1, (ymax - ymin) or 1
+    def key(i):
+        center = centers[i]
+        if center is None:
+            return 1 << (2 * HILBERT_ORDER)
+        return _hilbertIndex(int((center[0] - xmin) / width * cells),
+                             int((center[1] - ymin) / height * cells))
+    order = sorted(xrange(len(features)), key=key)
+    sortedFeatures = [lines[features[i]].rstrip(",") for i in order]
+    sortedFeatures = [f + "," for f in sortedFeatures[:-1]] + sortedFeatures[-1:]
+    return lines[:features[0]] + sortedFeatures + lines[features[-1] + 1:]
+
+def _geojsonSource(sink, filename, content, inlineThreshold = None):
+    """Returns a GeoJSON source for the passed GeoJSON content, and the
+    number of bytes written to the sink. If the content is smaller than
+    'inlineThreshold' bytes, it is included in the source instead of
+    being written to a file, to save a request when loading the map, and
+    any file created for it in the scratch path of the sink is removed.
+    """
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+    if inlineThreshold is not None and len(content) < inlineThreshold:
+        sink.discard(filename)
+        return {"type": "geojson", "data": json.loads(content)}, 0
+    return {"type": "geojson", "data": filename}, sink.write(filename, content)
+
+MAX_SEGMENT_SAMPLES = 10000
+
+def _geometryLines(geom):
+    """Returns the parts of a geometry as lists of points. Polygons are
+    returned as their rings.
+    """
+    if geom.type() == QGis.Point:
+        return [geom.asMultiPoint() if geom.isMultipart() else [geom.asPoint()]]
+    elif geom.type() == QGis.Line:
+        return geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+    elif geom.type() == QGis.Polygon:
+        polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+        return [ring for polygon in polygons for ring in polygon]
+    return []
+
+class _LayerStatistics(object):
+    """Collects the number of features and vertices of a layer, and a
+    sample of the lengths of its segments, from the features passed to
+    add() while they are written. The sample keeps every n-th segment,
+    doubling n whenever it grows over MAX_SEGMENT_SAMPLES segments, so it
+    is spread over the whole layer.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.count = 0
+        self.vertices = 0
+        self.segments = []
+        self._stride = 1
+        self._seen = 0
+
+    def add(self, feature):
+        self.count += 1
+        geom = feature.geometry()
+        if geom is None or geom.isGeosEmpty():
+            return
+        for line in _geometryLines(geom):
+            self.vertices += len(line)
+            for i in xrange(len(line) - 1):
+                if self._seen % self._stride == 0:
+                    self.segments.append(math.hypot(line[i + 1].x() - line[i].x(),
+                                                    line[i + 1].y() - line[i].y()))
+                    if len(self.segments) > MAX_SEGMENT_SAMPLES:
+                        self.segments = self.segments[::2]
+                        self._stride *= 2
+                self._seen += 1
+
+    def result(self):
+        """Returns a dict with the number of features and vertices, the
+        extent in EPSG:4326 and the median length of the segments, in
+        degrees"""
+        layer = self.layer
+        transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem("EPSG:4326"))
+        extent = transform.transform(layer.extent())
+        # segment lengths are converted to degrees with the ratio between extents
+        scale = extent.width() / layer.extent().width() if layer.extent().width() else 1
+        segments = sorted(self.segments)
+        segment = segments[len(segments) / 2] * scale if segments else None
+        return {"features": self.count, "vertices": self.vertices, "extent": extent,
+                "segment": segment}
+
+SCREEN_DPI = 96
+
+def _maxSymbolSize(layer):
+    """Returns the size of the largest symbol of a layer in pixels, which
+    are the units of the buffer of GeoJSON sources (1/512 of a tile)"""
+    renderer = layer.rendererV2()
+    if isinstance(renderer, QgsSingleSymbolRendererV2):
+        symbols = [renderer.symbol()]
+    elif isinstance(renderer, QgsCategorizedSymbolRendererV2):
+        symbols = [cat.symbol() for cat in renderer.categories()]
+    elif isinstance(renderer, QgsGraduatedSymbolRendererV2):
+        symbols = [ran.symbol() for ran in renderer.ranges()]
+    else:
+        return None
+    sizes = [0]
+    for symbol in symbols:
+        if isinstance(symbol, QgsMarkerSymbolV2):
+            size = symbol.size()
+        elif isinstance(symbol, QgsLineSymbolV2):
+            size = symbol.width()
+        else:
+            sizes.append(1)
+            continue
+        # sizes in map units depend on the zoom level, so they are not used
+        if symbol.outputUnit() == QgsSymbolV2.MM:
+            sizes.append(size * SCREEN_DPI / 25.4)
+        elif symbol.outputUnit() == QgsSymbolV2.Pixel:
+            sizes.append(size)
+    return max(sizes)
+
+def _geojsonSourceOptions(layer, stats):
+    """Returns the maxzoom, tolerance and buffer options for the GeoJSON
+    source of a layer, based on the statistics of its data.
+
+    The maxzoom is the first zoom level where the median segment (or the
+    average distance between points) is at least a few pixels long, so
+    more detailed tiles would not add anything. The simplification
+    tolerance grows with the number of vertices, and the buffer around
+    tiles is just enough for the largest symbol, unless the layer is
+    labelled and needs the default buffer for label placement.
+    """
+    options = {}
+    if stats["features"] == 0:
+        return options
+    if stats["segment"]:
+        detail = stats["segment"] / 4.0
+    else:
+        extent = stats["extent"]
+        detail = math.sqrt(extent.width() * extent.height() / stats["features"]) / 16.0
+    if detail > 0:
+        maxzoom = int(math.ceil(math.log(360.0 / (detail * 512), 2)))
+        options["maxzoom"] = max(0, min(18, maxzoom))
+    options["tolerance"] = round(max(0.375, min(1.5, 0.375 * math.sqrt(stats["vertices"] / 100000.0))), 3)
+    size = _maxSymbolSize(layer)
+    if size is not None and not _isLabeled(layer):
+        options["buffer"] = int(max(4, min(128, math.ceil(size + 4))))
+    return options
+
+WEB_MERCATOR_HALF_SIZE = 20037508.342789244
+
+def saveRasterTiles(layer, path, minzoom, maxzoom, extent = None, tileSize = 256, threads = 4,
+                    feedback = None):
+    """Renders a layer into an XYZ tile pyramid stored in an MBTiles file.
+    Web clients cannot read MBTiles files directly, so they need a tile
+    server to use it. Use saveRasterTileFolder to write files they can load.
+
+    Tiles are rendered in EPSG:3857 for the zoom levels between minzoom and
+    maxzoom, covering the passed extent (a QgsRectangle in EPSG:4326) or
+    the extent of the layer if it is None. Up to 'threads' tiles are
+    rendered at the same time, each of them by a parallel QGIS render job.
+    The layer must be loaded in the project. If a Feedback object is
+    passed, ExportCanceled is raised when it is canceled.
+    """
+    import sqlite3
+    extent = _rasterTilesExtent(layer, extent)
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    try:
+        db.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        db.execute("CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+                   "tile_row INTEGER, tile_data BLOB)")
+        db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        metadata = {"name": layer.name(), "type": "baselayer", "version": "1.0", "format": "png",
+                    "minzoom": str(minzoom), "maxzoom": str(maxzoom),
+                    "bounds": "%f,%f,%f,%f" % (extent.xMinimum(), extent.yMinimum(),
+                                               extent.xMaximum(), extent.yMaximum())}
+        db.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+        rows = []
+        for z, x, y, data in _renderedTiles(layer, extent, minzoom, maxzoom, tileSize, threads, feedback):
+            rows.append((z, x, (1 << z) - 1 - y, sqlite3.Binary(data)))
+            if len(rows) == threads:
+                db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", rows)
+                rows = []
+        db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", rows)
+        db.commit()
+    finally:
+        db.close()
+
+def saveRasterTileFolder(layer, folder, name, minzoom, maxzoom, extent = None, tileSize = 256,
+                         threads = 4, feedback = None):
+    """Renders a layer into an XYZ tile pyramid of PNG files, written to
+    '<name>/{z}/{x}/{y}.png' in the output folder (or output sink), which
+    Mapbox GL JS and OpenLayers load without a tile server. Returns the
+    number of bytes written. Tiles are rendered as in saveRasterTiles.
+    """
+    sink = _outputSink(folder)
+    size = 0
+    for z, x, y, data in _renderedTiles(layer, _rasterTilesExtent(layer, extent), minzoom, maxzoom,
+                                        tileSize, threads, feedback):
+        size += sink.write("%s/%i/%i/%i.png" % (name, z, x, y), data)
+    return size
+
+def _rasterTilesExtent(layer, extent):
+    if extent is not None:
+        return extent
+    transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem("EPSG:4326"))
+    return transform.transform(layer.extent())
+
+def _renderedTiles(layer, extent, minzoom, maxzoom, tileSize, threads, feedback):
+    """Renders the tiles of a layer covering an extent in EPSG:4326, and
+    yields their (z, x, y, PNG data) tuples"""
+    feedback = feedback or Feedback()
+    tiles = []
+    for z in xrange(minzoom, maxzoom + 1):
+        tiles.extend(_tilesForExtent(extent, z))
+    for i in xrange(0, len(tiles), threads):
+        _checkCanceled(feedback)
+        jobs = [(tile, _startTileRenderJob(layer, tile, tileSize)) for tile in tiles[i:i + threads]]
+        for (z, x, y), job in jobs:
+            job.waitForFinished()
+            data = QByteArray()
+            buff = QBuffer(data)
+            buff.open(QIODevice.WriteOnly)
+            job.renderedImage().save(buff, "PNG")
+            buff.close()
+            yield z, x, y, str(data)
+
+def _startTileRenderJob(layer, tile, tileSize):
+    z, x, y = tile
+    resolution = 2 * WEB_MERCATOR_HALF_SIZE / (1 << z)
+    xmin = -WEB_MERCATOR_HALF_SIZE + x * resolution
+    ymax = WEB_MERCATOR_HALF_SIZE - y * resolution
+    settings = QgsMapSettings()
+    settings.setLayers([layer.id()])
+    settings.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:3857"))
+    settings.setCrsTransformEnabled(True)
+    settings.setOutputSize(QSize(tileSize, tileSize))
+    settings.setOutputDpi(96)
+    settings.setBackgroundColor(QColor(Qt.transparent))
+    settings.setExtent(QgsRectangle(xmin, ymax - resolution, xmin + resolution, ymax))
+    job = QgsMapRendererParallelJob(settings)
+    job.start()
+    return job
+
+MAX_ZOOM = 24
+
+def _categoryCodes(layer):
+    """Returns a dict with the integer code to use for each value of the
+    class attribute of a categorized renderer, or None if the layer does
+    not use a categorized renderer on a string attribute.
+    """
+    renderer = layer.rendererV2()
+    if not isinstance(renderer, QgsCategorizedSymbolRendererV2):
+        return None
+    values = [cat.value() for cat in renderer.categories()]
+    if not any(isinstance(v, basestring) and v != "" for v in values):
+        return None
+    return OrderedDict((v, i) for i, v in enumerate(values) if v != "")
+
+def _categoriesFilename(layerName):
+    return "data/%s_categories.json" % layerName
+
+def _saveCategoryCodes(layer, codes, sink, filename):
+    renderer = layer.rendererV2()
+    labels = dict((cat.value(), cat.label()) for cat in renderer.categories())
+    table = {"property": renderer.classAttribute(),
+             "values": dict((code, value) for value, code in codes.iteritems()),
+             "labels": dict((code, labels[value]) for value, code in codes.iteritems())}
+    sink.write(filename, json.dumps(table, ensure_ascii=False))
+
+LABEL_SORT_KEY = "_sortkey"
+
+def _isLabeled(layer):
+    return str(layer.customProperty("labeling/enabled")).lower() == "true"
+
+def _hasLabelAnchors(layer):
+    return _isLabeled(layer) and layer.geometryType() in [QGis.Line, QGis.Polygon]
+
+def _labelAnchorsSourceName(layer):
+    return safeName(layer.name()) + "_labels"
+
+def _labelAnchors(layer, precision, feedback = None):
+    """Returns a point GeoJSON document with a label anchor for each feature
+    in the layer: the pole of inaccessibility of the largest part for
+    polygons and the middle point of the longest part for lines.
+
+    Each anchor has the value of the label field and a sort key computed
+    from the size of the feature, so labels from larger features are placed
+    first. The QGIS label priority of the layer is not used, since it is the
+    same for all its features and symbol-sort-key only orders the features
+    of a single style layer.
+    """
+    feedback = feedback or Feedback()
+    labelField = layer.customProperty("labeling/fieldName")
+    expression = QgsExpression(labelField)
+    expression.prepare(layer.pendingFields())
+    transform = QgsCoordinateTransform(layer.crs(), QgsCoordinateReferenceSystem("EPSG:4326"))
+    anchors = []
+    for i, feature in enumerate(layer.getFeatures()):
+        if i % CANCEL_CHECK_INTERVAL == 0:
+            _checkCanceled(feedback)
+        geom = feature.geometry()
+        if geom is None or geom.isGeosEmpty():
+            continue
+        try:
+            value = feature[labelField]
+        except KeyError:
+            value = expression.evaluate(feature)
+        if value is None or isinstance(value, QPyNullVariant) or unicode(value) == "":
+            continue
+        if layer.geometryType() == QGis.Polygon:
+            parts = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+            part = max(parts, key=lambda rings: abs(_ringArea(rings[0])))
+            anchor = _poleOfInaccessibility(part)
+            size = geom.area()
+        else:
+            parts = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+            part = max(parts, key=_lineLength)
+            anchor = _lineMidpoint(part)
+            size = geom.length()
+        if anchor is None:
+            continue
+        anchor = transform.transform(QgsPoint(anchor[0], anchor[1]))
+        anchors.append((anchor, _jsonValue(value), size))
+    maxSize = max([size for _, _, size in anchors] or [0]) or 1
+    features = []
+    for anchor, value, size in anchors:
+        sortKey = 1 - size / maxSize
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point",
+                                      "coordinates": [round(anchor.x(), precision),
+                                                      round(anchor.y(), precision)]},
+                         "properties": {labelField: value,
+                                        LABEL_SORT_KEY: round(sortKey, 4)}})
+    return json.dumps({"type": "FeatureCollection", "features": features},
+                      ensure_ascii=False, separators=(",", ":"))
+
+def _jsonValue(value):
+    """Returns an attribute value as a type that can be written to JSON.
+    Dates and times are written in ISO 8601 format, and other types as
+    their string representation"""
+    if isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, (QDate, QDateTime, QTime)):
+        return value.toString(Qt.ISODate)
+    return unicode(value)
+
+def _ringArea(ring):
+    area = 0
+    for i in xrange(len(ring) - 1):
+        area += ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1]
+    return area / 2.0
+
+def _lineLength(line):
+    return sum(math.hypot(line[i + 1][0] - line[i][0], line[i + 1][1] - line[i][1])
+               for i in xrange(len(line) - 1))
+
+def _lineMidpoint(line):
+    if not line:
+        return None
+    remaining = _lineLength(line) / 2.0
+    for i in xrange(len(line) - 1):
+        x0, y0 = line[i]
+        x1, y1 = line[i + 1]
+        segment = math.hypot(x1 - x0, y1 - y0)
+        if segment >= remaining and segment > 0:
+            ratio = remaining / segment
+            return x0 + (x1 - x0) * ratio, y0 + (y1 - y0) * ratio
+        remaining -= segment
+    return line[-1][0], line[-1][1]
+
+def _pointToPolygonDistance(x, y, rings):
+    inside = False
+    minDist = float("inf")
+    for ring in rings:
+        for i in xrange(len(ring)):
+            ax, ay = ring[i]
+            bx, by = ring[i - 1]
+            if (ay > y) != (by > y) and x < (bx - ax) * (y - ay) / (by - ay) + ax:
+                inside = not inside
+            dx, dy = bx - ax, by - ay
+            if dx != 0 or dy != 0:
+                t = max(0, min(1, ((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy)))
+                px, py = ax + t * dx, ay + t * dy
+            else:
+                px, py = ax, ay
+            minDist = min(minDist, (x - px) ** 2 + (y - py) ** 2)
+    return math.sqrt(minDist) * (1 if inside else -1)
+
+def _poleOfInaccessibility(rings, relativePrecision = 0.01):
+    """Returns the point inside the polygon that is farthest from its
+    boundary, using the iterative grid search from the polylabel algorithm.
+    """
+    outer = rings[0] if rings else []
+    if len(outer) < 3:
+        return None
+    xs = [p[0] for p in outer]
+    ys = [p[1] for p in outer]
+    minX, minY, maxX, maxY = min(xs), min(ys), max(xs), max(ys)
+    cellSize = min(maxX - minX, maxY - minY)
+    if cellSize == 0:
+        return outer[0][0], outer[0][1]
+    precision = max(maxX - minX, maxY - minY) * relativePrecision
+
+    def cell(x, y, h):
+        d = _pointToPolygonDistance(x, y, rings)
+        return (-(d + h * math.sqrt(2)), x, y, h, d)
+
+    queue = []
+    h = cellSize / 2.0
+    x = minX
+    while x < maxX:
+        y = minY
+        while y < maxY:
+            heapq.heappush(queue, cell(x + h, y + h, h))
+            y += cellSize
+        x += cellSize
+
+    area = _ringArea(outer)
+    if area != 0:
+        cx = sum((outer[i][0] + outer[i + 1][0]) *
+                 (outer[i][0] * outer[i + 1][1] - outer[i + 1][0] * outer[i][1])
+                 for i in xrange(len(outer) - 1)) / (6 * area)
+        cy = sum((outer[i][1] + outer[i + 1][1]) *
+                 (outer[i][0] * outer[i + 1][1] - outer[i + 1][0] * outer[i][1])
+                 for i in xrange(len(outer) - 1)) / (6 * area)
+        best = cell(cx, cy, 0)
+    else:
+        best = cell(outer[0][0], outer[0][1], 0)
+    bboxCell = cell(minX + (maxX - minX) / 2.0, minY + (maxY - minY) / 2.0, 0)
+    if bboxCell[4] > best[4]:
+        best = bboxCell
+
+    while queue:
+        current = heapq.heappop(queue)
+        _, x, y, h, d = current
+        if d > best[4]:
+            best = current
+        if -current[0] - best[4] <= precision:
+            continue
+        h = h / 2.0
+        for dx, dy in [(-h, -h), (h, -h), (-h, h), (h, h)]:
+            heapq.heappush(queue, cell(x + dx, y + dy, h))
+
+    return best[1], best[2]
+
 def _toZoomLevel(scale):
-    return int(math.log(1000000000 / scale, 2))
+    zoom = math.log(1000000000.0 / scale, 2)
+    return round(max(0, min(MAX_ZOOM, zoom)), 2)
 
 def _toScale(level):
     return 1000000000 / (math.pow(2, level))
 
+def _scaleRangeToZooms(minScale, maxScale):
+    """Converts a QGIS scale denominator range into Mapbox GL minzoom
+    and maxzoom values. A denominator of 0 means no limit on that side.
+    Notice that the maximum scale (largest denominator, most zoomed out)
+    gives the minimum zoom level, and viceversa.
+    """
+    zooms = {}
+    if maxScale > 0:
+        zooms["minzoom"] = _toZoomLevel(maxScale)
+    if minScale > 0:
+        zooms["maxzoom"] = _toZoomLevel(minScale)
+    return zooms
+
+def _layerZooms(qgisLayer):
+    if qgisLayer.hasScaleBasedVisibility():
+        return _scaleRangeToZooms(qgisLayer.minimumScale(), qgisLayer.maximumScale())
+    return {}
+
+def _labelingZooms(qgisLayer):
+    zooms = _layerZooms(qgisLayer)
+    if str(qgisLayer.customProperty("labeling/scaleVisibility")).lower() == "true":
+        try:
+            labelZooms = _scaleRangeToZooms(float(qgisLayer.customProperty("labeling/scaleMin")),
+                                            float(qgisLayer.customProperty("labeling/scaleMax")))
+        except (TypeError, ValueError):
+            labelZooms = {}
+        if "minzoom" in labelZooms:
+            zooms["minzoom"] = max(labelZooms["minzoom"], zooms.get("minzoom", 0))
+        if "maxzoom" in labelZooms:
+            zooms["maxzoom"] = min(labelZooms["maxzoom"], zooms.get("maxzoom", MAX_ZOOM))
+    return zooms
+
+def _setZooms(layer, zooms):
+    if zooms.get("minzoom", 0) > 0:
+        layer["minzoom"] = zooms["minzoom"]
+    if zooms.get("maxzoom", MAX_ZOOM) < MAX_ZOOM:
+        layer["maxzoom"] = zooms["maxzoom"]
+
 def _property(s, iSymbolLayer, default=None):
     def _f(x):
         if iSymbolLayer >= x.symbolLayerCount():
@@ -320,7 +2096,8 @@ def _checkUnitsProperty(qgisLayer, symbols, iSymbolLayer, prop):
                 "uses units other than pixels. Only pixels are supported"
                  % (qgisLayer.name(), k, iSymbolLayer + 1), level=QgsMessageLog.WARNING)
 
-def _convertSymbologyForLayer(qgisLayer, symbols, functionType, attribute):
+def _convertSymbologyForLayer(qgisLayer, symbols, functionType, attribute, stats = None):
+    stats = stats or _NO_STATS
     layers = []
     sprites = {}
     if not isinstance(symbols, OrderedDict):
@@ -342,9 +2119,7 @@ def _convertSymbologyForLayer(qgisLayer, symbols, functionType, attribute):
                         QgsMessageLog.logMessage("Warning: marker symbol in layer '%s' (class '%s', symbol layer number %i) "
                             "uses units other than pixels. Only pixels are supported"
                             % (qgisLayer.name(), k, iSymbolLayer + 1), level=QgsMessageLog.WARNING)
-                    img, img2x = _saveSymbolLayerSprite(symbol, iSymbolLayer)
-                    if img is not None:
-                        sprites[_iconName(iSymbolLayer)(symbol)] = (img, img2x)
+                    _addSprite(sprites, symbol, iSymbolLayer, qgisLayer, stats)
             _setPaintProperty(paint, "icon-image", symbols, _iconName(iSymbolLayer), functionType, attribute)
         elif layerType == "line":
             _checkUnitsProperty(qgisLayer, symbols, iSymbolLayer, "line_width_unit")
@@ -361,9 +2136,7 @@ def _convertSymbologyForLayer(qgisLayer, symbols, functionType, attribute):
                 _symbols = {"singlesymbol": symbols}
             for symbol in _symbols.values():
                 if iSymbolLayer < symbol.symbolLayerCount():
-                    img, img2x = _saveSymbolLayerSprite(symbol, iSymbolLayer)
-                    if img:
-                        sprites[_iconName(iSymbolLayer)(symbol)] = (img, img2x)
+                    _addSprite(sprites, symbol, iSymbolLayer, qgisLayer, stats)
             _setPaintProperty(paint, "fill-pattern", symbols, _fillPatternIcon(iSymbolLayer), functionType, attribute)
             _setPaintProperty(paint, "fill-opacity", symbols, _alpha(iSymbolLayer), functionType, attribute)
             _setPaintProperty(paint, "fill-translate", symbols, _property("offset", iSymbolLayer, 0), functionType, attribute)
@@ -373,6 +2146,18 @@ def _convertSymbologyForLayer(qgisLayer, symbols, functionType, attribute):
 
     return sprites, layers
 
+def _addSprite(sprites, symbol, iSymbolLayer, qgisLayer, stats):
+    name = _iconName(iSymbolLayer)(symbol)
+    layerName = safeName(qgisLayer.name())
+    if name in sprites:
+        stats.count("spritesCached", 1, layerName)
+        return
+    with stats.stage("renderSprite", layerName):
+        img, img2x = _saveSymbolLayerSprite(symbol, iSymbolLayer)
+    if img:
+        sprites[name] = (img, img2x)
+        stats.count("spritesRendered", 1, layerName)
+
 def _setPaintProperty(paint, property, obj, func, funcType, attribute):
     if isinstance(obj, OrderedDict):
         d = {}
@@ -399,9 +2184,11 @@ def _getLayerType(qgisLayer):
         return "symbol"
 
 
-def processLayer(qgisLayer):
+def processLayer(qgisLayer, labelAnchors = False, localGlyphs = False, encodeCategories = False,
+                 rasterTiles = None, stats = None):
     allLayers = []
     allSprites = {}
+    codes = None
     if qgisLayer.type() == qgisLayer.VectorLayer:
         try:
             renderer = qgisLayer.rendererV2()
@@ -411,8 +2198,14 @@ def processLayer(qgisLayer):
                 prop = None
             elif isinstance(renderer, QgsCategorizedSymbolRendererV2):
                 symbols = OrderedDict()
+                codes = _categoryCodes(qgisLayer) if encodeCategories else None
                 for cat in renderer.categories():
-                    symbols[cat.value()] = cat.symbol().clone()
+                    if codes:
+                        if cat.value() not in codes:
+                            continue
+                        symbols[codes[cat.value()]] = cat.symbol().clone()
+                    else:
+                        symbols[cat.value()] = cat.symbol().clone()
                 functionType = "categorical"
                 prop = renderer.classAttribute()
             elif isinstance(renderer, QgsGraduatedSymbolRendererV2):
@@ -425,13 +2218,13 @@ def processLayer(qgisLayer):
                 QgsMessageLog.logMessage("Warning: unsupported renderer:" + renderer.__class__.__name__, level=QgsMessageLog.WARNING)
                 return {}, []
 
-            sprites, layers = _convertSymbologyForLayer(qgisLayer, symbols, functionType, prop)
+            sprites, layers = _convertSymbologyForLayer(qgisLayer, symbols, functionType, prop, stats)
             for i, layer in enumerate(layers):
                 layer["id"] = "%s:%i" % (safeName(qgisLayer.name()), i)
                 layer["source"] = safeName(qgisLayer.name())
-                if str(qgisLayer.customProperty("labeling/scaleVisibility")).lower() == "true":
-                    mapboxLayer["minzoom"]  = _toZoomLevel(float(qgisLayer.customProperty("labeling/scaleMin")))
-                    mapboxLayer["maxzoom"]  = _toZoomLevel(float(qgisLayer.customProperty("labeling/scaleMax")))
+                if codes:
+                    layer["metadata"] = {"qgis:categories": _categoriesFilename(safeName(qgisLayer.name()))}
+                _setZooms(layer, _layerZooms(qgisLayer))
                 allLayers.append(layer)
 
             allSprites.update(sprites)
@@ -441,32 +2234,50 @@ def processLayer(qgisLayer):
             QgsMessageLog.logMessage("ERROR: " + traceback.format_exc(), level=QgsMessageLog.CRITICAL)
             return {}, []
 
-        if str(qgisLayer.customProperty("labeling/enabled")).lower() == "true":
-            allLayers.append(processLabeling(qgisLayer))
+        if _isLabeled(qgisLayer):
+            allLayers.append(processLabeling(qgisLayer, labelAnchors, localGlyphs, codes))
+    elif rasterTiles is None and qgisLayer.providerType().lower() != "wms":
+        QgsMessageLog.logMessage("Warning: raster layer '%s' is not a WMS layer. Local raster layers "
+                                 "are only exported when rendering raster tiles" % qgisLayer.name(),
+                                 level=QgsMessageLog.WARNING)
     else:
         layer  = {}
         layer["id"] = safeName(qgisLayer.name())
         layer["type"] = "raster"
         layer["source"] = safeName(qgisLayer.name())
         layer["paint"] = {}
+        _setZooms(layer, _layerZooms(qgisLayer))
+        allLayers.append(layer)
 
     return allSprites, allLayers
 
-def processLabeling(qgisLayer):
+def processLabeling(qgisLayer, labelAnchors = False, localGlyphs = False, codes = None):
     layer = {}
     layer["id"] = "txt_" + safeName(qgisLayer.name())
     layer["source"] =  safeName(qgisLayer.name())
     layer["type"] = "symbol"
 
     layer["layout"] = {}
+    if labelAnchors and _hasLabelAnchors(qgisLayer):
+        layer["source"] = _labelAnchorsSourceName(qgisLayer)
+        layer["metadata"] = {"qgis:layer": safeName(qgisLayer.name())}
+        layer["layout"]["symbol-sort-key"] = {"type": "identity", "property": LABEL_SORT_KEY}
     labelField = qgisLayer.customProperty("labeling/fieldName")
     layer["layout"]["text-field"] = "{%s}" % labelField
+    if (codes and labelField == qgisLayer.rendererV2().classAttribute()
+            and layer["source"] == safeName(qgisLayer.name())):
+        layer["layout"]["text-field"] = {"property": labelField,
+                                         "type": "categorical",
+                                         "stops": [[code, unicode(value)] for value, code in codes.iteritems()]}
     try:
         size = float(qgisLayer.customProperty("labeling/fontSize"))
     except:
         size = 1
     layer["layout"]["text-size"] = size
-    layer["layout"]["text-font"] =  ["Arial Normal"]
+    if localGlyphs:
+        layer["layout"]["text-font"] = [_labelFontstack(qgisLayer)]
+    else:
+        layer["layout"]["text-font"] =  ["Arial Normal"]
 
     layer["paint"] = {}
     r = qgisLayer.customProperty("labeling/textColorR")
@@ -499,13 +2310,212 @@ def processLabeling(qgisLayer):
     # textAlign = textAligns[quad % 3]
     #===========================================================================
 
-    if str(qgisLayer.customProperty("labeling/scaleVisibility")).lower() == "true":
-        layer["minzoom"]  = _toZoomLevel(float(qgisLayer.customProperty("labeling/scaleMin")))
-        layer["maxzoom"]  = _toZoomLevel(float(qgisLayer.customProperty("labeling/scaleMax")))
+    _setZooms(layer, _labelingZooms(qgisLayer))
 
     return layer
 
 
+GLYPH_SIZE = 24
+GLYPH_BUFFER = 3
+GLYPH_RADIUS = 8
+GLYPH_CUTOFF = 0.25
+
+def _labelFontFlags(qgisLayer):
+    bold = str(qgisLayer.customProperty("labeling/fontBold")).lower() == "true"
+    italic = str(qgisLayer.customProperty("labeling/fontItalic")).lower() == "true"
+    return bold, italic
+
+def _labelFontstack(qgisLayer):
+    """Returns the font stack name of the labels of a layer. It uses the
+    named style of the font or, if it is not set, the same bold and italic
+    flags used by _labelFont to render its glyphs"""
+    family = qgisLayer.customProperty("labeling/fontFamily") or "Arial"
+    style = qgisLayer.customProperty("labeling/namedStyle")
+    if not style:
+        bold, italic = _labelFontFlags(qgisLayer)
+        style = " ".join(["Bold"] * bold + ["Italic"] * italic) or "Regular"
+    return "%s %s" % (family, style)
+
+def _labelFont(qgisLayer):
+    font = QFont(qgisLayer.customProperty("labeling/fontFamily") or "Arial")
+    bold, italic = _labelFontFlags(qgisLayer)
+    font.setBold(bold)
+    font.setItalic(italic)
+    namedStyle = qgisLayer.customProperty("labeling/namedStyle")
+    if namedStyle:
+        font.setStyleName(namedStyle)
+    font.setPixelSize(GLYPH_SIZE)
+    return font
+
+class _LabelCodepoints(object):
+    """Adds the codepoints of the label values of the features passed to
+    add() to a set, so they can be collected while the features are
+    written"""
+
+    def __init__(self, layer, codepoints):
+        self.codepoints = codepoints
+        labelField = layer.customProperty("labeling/fieldName")
+        self.index = layer.fieldNameIndex(labelField)
+        self.expression = QgsExpression(labelField)
+        self.expression.prepare(layer.pendingFields())
+
+    def add(self, feature):
+        value = feature[self.index] if self.index != -1 else self.expression.evaluate(feature)
+        if value is None or isinstance(value, QPyNullVariant):
+            return
+        self.codepoints.update(ord(c) for c in unicode(value) if c != u"\0")
+
+def _collectLabelCodepoints(layer, codepoints, feedback = None):
+    """Adds the codepoints of the label values of a layer to a set, reading
+    its features without geometries"""
+    feedback = feedback or Feedback()
+    collector = _LabelCodepoints(layer, codepoints)
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    if collector.index != -1:
+        request.setSubsetOfAttributes([collector.index])
+    for i, feature in enumerate(layer.getFeatures(request)):
+        if i % CANCEL_CHECK_INTERVAL == 0:
+            _checkCanceled(feedback)
+        collector.add(feature)
+
+def saveGlyphs(folder, layers, codepoints):
+    """Writes SDF glyph PBF files for the given font stacks, in the
+    folder structure expected by the 'glyphs/{fontstack}/{range}.pbf' URL.
+    Only the 256-codepoint ranges that contain a used codepoint are written,
+    and they only contain the glyphs for those codepoints.
+
+    'codepoints' is a dict with font stack names as keys and sets of
+    codepoints as values. Glyphs are rendered with the label font of the
+    first layer using each font stack.
+    """
+    _writeGlyphs(_outputSink(folder), _labelFonts(layers), codepoints)
+
+def _labelFonts(layers):
+    """Returns a dict with the label font of the first labeled layer using
+    each font stack, with the font stack names as keys"""
+    fonts = {}
+    for layer in layers:
+        if layer.type() == layer.VectorLayer and _isLabeled(layer):
+            fonts.setdefault(_labelFontstack(layer), _labelFont(layer))
+    return fonts
+
+def _writeGlyphs(sink, fonts, codepoints):
+    for fontstack, chars in codepoints.iteritems():
+        font = fonts.get(fontstack, QFont(fontstack.rsplit(" ", 1)[0]))
+        font.setPixelSize(GLYPH_SIZE)
+        ranges = {}
+        for codepoint in chars:
+            if codepoint > 0xffff:
+                continue
+            ranges.setdefault(codepoint // 256, []).append(codepoint)
+        for r, rangeCodepoints in ranges.iteritems():
+            rangeName = "%i-%i" % (r * 256, r * 256 + 255)
+            glyphs = [_renderGlyph(font, codepoint) for codepoint in sorted(rangeCodepoints)]
+            fontstackMessage = (_pbfString(1, fontstack) + _pbfString(2, rangeName)
+                                + "".join(_pbfBytes(3, glyph) for glyph in glyphs))
+            sink.write("glyphs/%s/%s.pbf" % (fontstack, rangeName), _pbfBytes(1, fontstackMessage))
+
+def _renderGlyph(font, codepoint):
+    char = unichr(codepoint)
+    metrics = QFontMetrics(font)
+    rect = metrics.boundingRect(char)
+    advance = metrics.width(char)
+    width, height = max(rect.width(), 0), max(rect.height(), 0)
+    glyph = _pbfVarint(1, codepoint)
+    if width and height and not char.isspace():
+        w, h = width + 2 * GLYPH_BUFFER, height + 2 * GLYPH_BUFFER
+        img = QImage(w, h, QImage.Format_ARGB32)
+        img.fill(QColor(Qt.transparent))
+        painter = QPainter(img)
+        painter.setFont(font)
+        painter.setPen(QColor(Qt.black))
+        painter.drawText(GLYPH_BUFFER - rect.left(), GLYPH_BUFFER - rect.top(), char)
+        painter.end()
+        alpha = [[qAlpha(img.pixel(x, y)) / 255.0 for x in xrange(w)] for y in xrange(h)]
+        glyph += _pbfBytes(2, _sdf(alpha, w, h))
+    else:
+        width = height = 0
+    glyph += (_pbfVarint(3, width) + _pbfVarint(4, height)
+              + _pbfSVarint(5, rect.left()) + _pbfSVarint(6, -rect.top() - metrics.ascent())
+              + _pbfVarint(7, advance))
+    return glyph
+
+_INF = 1e20
+
+def _edt1d(f):
+    n = len(f)
+    d = [0] * n
+    v = [0] * n
+    z = [0] * (n + 1)
+    k = 0
+    z[0] = -_INF
+    z[1] = _INF
+    for q in xrange(1, n):
+        s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2.0 * q - 2 * v[k])
+        while s <= z[k]:
+            k -= 1
+            s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2.0 * q - 2 * v[k])
+        k += 1
+        v[k] = q
+        z[k] = s
+        z[k + 1] = _INF
+    k = 0
+    for q in xrange(n):
+        while z[k + 1] < q:
+            k += 1
+        d[q] = (q - v[k]) ** 2 + f[v[k]]
+    return d
+
+def _edt(grid, w, h):
+    for x in xrange(w):
+        column = _edt1d([grid[y][x] for y in xrange(h)])
+        for y in xrange(h):
+            grid[y][x] = column[y]
+    for y in xrange(h):
+        grid[y] = _edt1d(grid[y])
+    return grid
+
+def _sdf(alpha, w, h):
+    """Computes the signed distance field of a glyph from its alpha values,
+    as done by TinySDF, and returns it as a byte string.
+    """
+    outer = [[0 if a == 1 else _INF if a == 0 else max(0, 0.5 - a) ** 2 for a in row]
+             for row in alpha]
+    inner = [[_INF if a == 1 else 0 if a == 0 else max(0, a - 0.5) ** 2 for a in row]
+             for row in alpha]
+    outer = _edt(outer, w, h)
+    inner = _edt(inner, w, h)
+    data = bytearray()
+    for y in xrange(h):
+        for x in xrange(w):
+            d = math.sqrt(outer[y][x]) - math.sqrt(inner[y][x])
+            value = int(round(255 - 255 * (d / GLYPH_RADIUS + GLYPH_CUTOFF)))
+            data.append(max(0, min(255, value)))
+    return str(data)
+
+def _varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return str(data)
+
+def _pbfVarint(field, value):
+    return _varint(field << 3) + _varint(value)
+
+def _pbfSVarint(field, value):
+    return _pbfVarint(field, (value << 1) ^ (value >> 63))
+
+def _pbfBytes(field, data):
+    return _varint((field << 3) | 2) + _varint(len(data)) + data
+
+def _pbfString(field, text):
+    return _pbfBytes(field, text.encode("utf-8"))
+
 def safeName(name):
     #TODO: we are assuming that at least one character is valid...
     validChars = '123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_'
@@ -519,7 +2529,9 @@ def _qcolorFromRGBString(color):
 def _fillSymbolLayer(color, outlineColor, translate):
     symbolLayer = QgsSimpleFillSymbolLayerV2()
     symbolLayer.setBorderColor(_qcolorFromRGBString(outlineColor))
-    x,y = translate.split(",")
+    if isinstance(translate, basestring):
+        translate = translate.split(",")
+    x, y = translate
     symbolLayer.setOffset(QPointF(float(x), float(y)))
     symbolLayer.setFillColor(_qcolorFromRGBString(color))
     return symbolLayer
@@ -533,7 +2545,7 @@ def _fillSymbol(color, outlineColor, translate, opacity):
 
 def _svgFillSymbolLayer(outlineColor, fillPattern, sprites):
     symbolLayer = QgsSVGFillSymbolLayer()
-    svgPath, size = _getSvgPath(fillPattern, sprites)
+    svgPath, size = sprites.svgPath(fillPattern)
     symbolLayer.setSvgFilePath(svgPath)
     symbolLayer.setPatternWidth(size)
     symbolLayer.setOutputUnit(QgsSymbolV2.Pixel)
@@ -561,28 +2573,52 @@ def _lineSymbol(color, width, dash, offset, opacity):
     symbol.deleteSymbolLayer(0)
     symbol.setAlpha(opacity)
 
-def _getSvgPath(name, sprites):
-    #TODO: see if there is a built-in sprite with that name
-    if name is None:
-        return None, None
-    with open(sprites + ".json") as f:
-        spritesDict = json.load(f)
-    rect = QRect(spritesDict[name]["x"], spritesDict[name]["y"],
-                spritesDict[name]["width"], spritesDict[name]["height"])
-    width = spritesDict[name]["width"]
-    height = spritesDict[name]["height"]
-    image = QImage()
-    image.load(sprites + ".png")
-    sprite = image.copy(rect)
-    pngPath = os.path.join(os.path.dirname(sprites), name + ".png")
-    sprite.save(pngPath)
-    with open(pngPath, "rb") as f:
-        data = f.read()
-    base64 = data.encode("base64")
-    svgPath = os.path.join(os.path.dirname(sprites), name + ".svg")
-    with open(svgPath, "w") as f:
-        f.write(_svgTemplate % {"w": width, "h": height, "b64": base64 })
-    return svgPath, max([width, height])
+class SpriteSheet(object):
+    """Sprite sheet referenced by a Mapbox GL style, used when importing it.
+
+    The sprites index and image are read only once, and each sprite is
+    saved as an SVG file (which is what QGIS symbol layers use) the first
+    time it is requested. Later requests for the same sprite reuse that file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(path)
+        self._index = None
+        self._image = None
+        self._svgPaths = {}
+
+    def index(self):
+        if self._index is None:
+            with open(self.path + ".json") as f:
+                self._index = json.load(f)
+        return self._index
+
+    def image(self):
+        if self._image is None:
+            self._image = QImage()
+            self._image.load(self.path + ".png")
+        return self._image
+
+    def svgPath(self, name):
+        #TODO: see if there is a built-in sprite with that name
+        if name is None:
+            return None, None
+        if name not in self._svgPaths:
+            sprite = self.index()[name]
+            width = sprite["width"]
+            height = sprite["height"]
+            rect = QRect(sprite["x"], sprite["y"], width, height)
+            data = QByteArray()
+            buff = QBuffer(data)
+            buff.open(QIODevice.WriteOnly)
+            self.image().copy(rect).save(buff, "PNG")
+            buff.close()
+            svgPath = os.path.join(self.folder, name + ".svg")
+            with open(svgPath, "w") as f:
+                f.write(_svgTemplate % {"w": width, "h": height, "b64": str(data.toBase64())})
+            self._svgPaths[name] = (svgPath, max([width, height]))
+        return self._svgPaths[name]
 
 _svgTemplate =  """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
     <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
@@ -597,7 +2633,7 @@ _svgTemplate =  """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 def _svgMarkerSymbolLayer(name, sprites):
     if name is None:
         return None
-    svgPath, size = _getSvgPath(name, sprites)
+    svgPath, size = sprites.svgPath(name)
     symbolLayer = QgsSvgMarkerSymbolLayerV2(svgPath)
     symbolLayer.setSize(size)
     symbolLayer.setOutputUnit(QgsSymbolV2.Pixel)
@@ -609,116 +2645,148 @@ def _svgMarkerSymbol(name, sprites):
     symbol.deleteSymbolLayer(0)
     return symbol
 
-def _getCategoryOrRange(layer, name):
-    renderer = layer.rendererV2()
+def _categoryLabel(style, value):
+    labels = style.get("metadata", {}).get("qgis:categoryLabels", {})
+    return labels.get(str(value), str(value))
+
+def _rendererIndex(renderer):
+    """Returns a dict with the label of each category or range of the
+    renderer as keys and (index, category or range) tuples as values.
+    """
     if isinstance(renderer, QgsCategorizedSymbolRendererV2):
-        cats = renderer.categories()
-        for i, cat in enumerate(cats):
-            if cat.label() == name:
-                return i, cat
-        return -1, None
+        items = renderer.categories()
+    elif isinstance(renderer, QgsGraduatedSymbolRendererV2):
+        items = renderer.ranges()
     else:
-        ranges = renderer.ranges()
-        for i, rang in enumerate(ranges):
-            if rang.label() == name:
-                return i, rang
-        return -1, None
+        items = []
+    return dict((item.label(), (i, item)) for i, item in enumerate(items))
 
 layerTypes = {QGis.Point: ["circle", "symbol"], QGis.Line: ["line"], QGis.Polygon: ["fill"]}
+# black, the default color of the style specification, in the format written by the exporter
+DEFAULT_COLOR = "rgb(0,0,0)"
 
 def setLayerSymbologyFromMapboxStyle(layer, style, sprites, add):
-    if style["type"] not in layerTypes[layer.geometryType()]:
+    renderer = layer.rendererV2().clone() if add else None
+    renderer = _rendererFromMapboxStyle(layer, style, sprites, renderer)
+    if renderer is None:
         return
+    layer.setRendererV2(renderer)
+    _setLayerScaleVisibilityFromMapboxStyle(layer, style)
+    iface.legendInterface().refreshLayerSymbology(layer)
+    layer.triggerRepaint()
+
+def _styleStop(value, i, default):
+    """Returns the value of a style property for the i-th stop of the
+    function that drives the layer symbology, or its value if it is a
+    constant. If the property is not set, the default value is returned"""
+    if value is None:
+        return default
+    if isinstance(value, dict):
+        try:
+            return value["stops"][i][1]
+        except (KeyError, IndexError, TypeError):
+            return default
+    return value
+
+def _rendererFromMapboxStyle(layer, style, sprites, renderer = None):
+    """Returns a renderer for the passed layer with the symbology described
+    in a Mapbox GL style layer. If a renderer is passed, the symbol layers
+    from the style are added to its symbols instead, so several style layers
+    can be combined in a single renderer before setting it to the layer.
+    The layer itself is not modified. Properties missing from the style
+    take the default values of the style specification.
+    """
+    if style["type"] not in layerTypes[layer.geometryType()]:
+        return renderer
+    if isinstance(sprites, basestring):
+        sprites = SpriteSheet(sprites)
+    add = renderer is not None
+    if add:
+        index = _rendererIndex(renderer)
+    paint = style.get("paint", {})
+    layout = style.get("layout", {})
 
     if style["type"] == "line":
-        if isinstance(style["paint"]["line-color"], dict):
-            if style["paint"]["line-color"]["type"] == "categorical":
+        lineColor = paint.get("line-color", DEFAULT_COLOR)
+        def lineProperties(i):
+            return (_styleStop(paint.get("line-width"), i, 1),
+                    _styleStop(paint.get("line-dasharray"), i, None),
+                    _styleStop(paint.get("line-offset"), i, 0),
+                    _styleStop(paint.get("line-opacity"), i, 1))
+        if isinstance(lineColor, dict):
+            if lineColor.get("type") == "categorical":
                 categories = []
-                for i, stop in enumerate(style["paint"]["line-color"]["stops"]):
-                    dash = style["paint"]["line-dasharray"]["stops"][i][1]
-                    width = style["paint"]["line-width"]["stops"][i][1]
-                    offset = style["paint"]["line-offset"]["stops"][i][1]
-                    opacity = style["paint"]["line-opacity"]["stops"][i][1]
+                for i, stop in enumerate(lineColor["stops"]):
+                    width, dash, offset, opacity = lineProperties(i)
                     color = stop[1]
                     value = stop[0]
                     if add:
-                        idx, cat = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, cat = index.get(_categoryLabel(style, value), (-1, None))
+                        if idx != -1:
                             symbol = cat.symbol().clone()
                             symbolLayer = _lineSymbolLayer(color, width, dash, offset)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateCategorySymbol(idx, symbol)
+                                renderer.updateCategorySymbol(idx, symbol)
                     else:
                         symbol = _lineSymbol(color, width, dash, offset, opacity)
-                        categories.append(QgsRendererCategoryV2(value, symbol, str(value)))
+                        categories.append(QgsRendererCategoryV2(value, symbol, _categoryLabel(style, value)))
                 if not add:
-                    renderer = QgsCategorizedSymbolRendererV2(style["paint"]["line-color"]["property"], categories)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsCategorizedSymbolRendererV2(lineColor["property"], categories)
             else:
                 ranges = []
-                for i, stop in enumerate(style["paint"]["line-color"]["stops"]):
-                    dash = style["paint"]["line-dasharray"]["stops"][i][1]
-                    width = style["paint"]["line-width"]["stops"][i][1]
-                    offset = style["paint"]["line-offset"]["stops"][i][1]
-                    opacity = style["paint"]["line-opacity"]["stops"][i][1]
+                for i, stop in enumerate(lineColor["stops"]):
+                    width, dash, offset, opacity = lineProperties(i)
                     color = stop[1]
                     minValue = stop[0]
                     try:
-                        maxValue = style["paint"]["line-color"]["stops"][i+1][0]
+                        maxValue = lineColor["stops"][i+1][0]
                     except:
                         maxValue = 100000000000
                     rangeName = str(minValue) + "-" + str(maxValue)
                     if add:
-                        idx, rang = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, rang = index.get(rangeName, (-1, None))
+                        if idx != -1:
                             symbol = rang.symbol().clone()
                             symbolLayer = _lineSymbolLayer(color, width, dash, offset)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateRangeSymbol(idx, symbol)
+                                renderer.updateRangeSymbol(idx, symbol)
                     else:
                         symbol = _lineSymbol(color, width, dash, offset, opacity)
                         ranges.append(QgsRendererRangeV2(minValue, maxValue, symbol, rangeName))
                 if not add:
-                    renderer = QgsGraduatedSymbolRendererV2(style["paint"]["line-color"]["property"], ranges)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsGraduatedSymbolRendererV2(lineColor["property"], ranges)
         else:
-            dash = style["paint"]["line-dasharray"]
-            width = style["paint"]["line-width"]
-            offset = style["paint"]["line-offset"]
-            opacity = style["paint"]["line-opacity"]
-            color = style["paint"]["line-color"]
+            width, dash, offset, opacity = lineProperties(0)
+            color = lineColor
             if add:
-                symbol = layer.rendererV2().symbol().clone()
+                symbol = renderer.symbol().clone()
                 symbolLayer = _lineSymbolLayer(color, width, dash, offset)
                 if symbolLayer is not None:
                     symbol.appendSymbolLayer(symbolLayer)
-                    layer.rendererV2().setSymbol(symbol)
+                    renderer.setSymbol(symbol)
             else:
                 symbol = _lineSymbol(color, width, dash, offset, opacity)
-                layer.setRendererV2(QgsSingleSymbolRendererV2(symbol))
+                renderer = QgsSingleSymbolRendererV2(symbol)
     elif style["type"] == "fill":
-        var = style["paint"]["fill-color"] if "fill-color" in style["paint"] else style["paint"]["fill-pattern"]
+        var = paint.get("fill-color", paint.get("fill-pattern", DEFAULT_COLOR))
+        def fillProperties(i):
+            color = _styleStop(paint.get("fill-color"), i, DEFAULT_COLOR)
+            return (color,
+                    _styleStop(paint.get("fill-outline-color"), i, color),
+                    _styleStop(paint.get("fill-translate"), i, [0, 0]),
+                    _styleStop(paint.get("fill-opacity"), i, 1),
+                    _styleStop(paint.get("fill-pattern"), i, None))
         if isinstance(var, dict):
-            if var["type"] == "categorical":
+            if var.get("type") == "categorical":
                 categories = []
                 for i, stop in enumerate(var["stops"]):
-                    outlineColor = style["paint"]["fill-outline-color"]["stops"][i][1]
-                    try:
-                        translate = style["paint"]["fill-translate"]["stops"][i][1]
-                    except:
-                        translate = 0
-                    opacity = style["paint"]["fill-opacity"]["stops"][i][1]
-                    try:
-                        fillPattern = style["paint"]["fill-pattern"]["stops"][i][1]
-                    except KeyError:
-                        fillPattern = None
-                        color = stop[1]
+                    color, outlineColor, translate, opacity, fillPattern = fillProperties(i)
                     value = stop[0]
                     if add:
-                        idx, cat = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, cat = index.get(_categoryLabel(style, value), (-1, None))
+                        if idx != -1:
                             symbol = cat.symbol().clone()
                             if fillPattern is None:
                                 symbolLayer = _fillSymbolLayer(color, outlineColor, translate)
@@ -726,39 +2794,28 @@ def setLayerSymbologyFromMapboxStyle(layer, style, sprites, add):
                                 symbolLayer = _svgFillSymbolLayer(outlineColor, fillPattern, sprites)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateCategorySymbol(idx, symbol)
+                                renderer.updateCategorySymbol(idx, symbol)
                     else:
                         if fillPattern is None:
                             symbol = _fillSymbol(color, outlineColor, translate, opacity)
                         else:
-                            symbol = _svgFillSymbol(outlineColor, fillPattern, sprites, opacity)
-                        categories.append(QgsRendererCategoryV2(value, symbol, str(value)))
+                            symbol = _svgFillSymbol(outlineColor, opacity, fillPattern, sprites)
+                        categories.append(QgsRendererCategoryV2(value, symbol, _categoryLabel(style, value)))
                 if not add:
-                    renderer = QgsCategorizedSymbolRendererV2(style["paint"]["fill-color"]["property"], categories)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsCategorizedSymbolRendererV2(var["property"], categories)
             else:
                 ranges = []
                 for i, stop in enumerate(var["stops"]):
-                    outlineColor = style["paint"]["fill-outline-color"]["stops"][i][1]
-                    try:
-                        translate = style["paint"]["fill-translate"]["stops"][i][1]
-                    except:
-                        translate = 0
-                    opacity = style["paint"]["fill-opacity"]["stops"][i][1]
-                    try:
-                        fillPattern = style["paint"]["fill-pattern"]["stops"][i][1]
-                    except KeyError:
-                        fillPattern = None
-                        color = stop[1]
+                    color, outlineColor, translate, opacity, fillPattern = fillProperties(i)
                     minValue = stop[0]
                     try:
-                        maxValue = style["paint"]["fill-color"]["stops"][i+1][0]
+                        maxValue = var["stops"][i+1][0]
                     except:
                         maxValue = 100000000000
                     rangeName = str(minValue) + "-" + str(maxValue)
                     if add:
-                        idx, rang = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, rang = index.get(rangeName, (-1, None))
+                        if idx != -1:
                             symbol = rang.symbol().clone()
                             if fillPattern is None:
                                 symbolLayer = _fillSymbolLayer(color, outlineColor, translate)
@@ -766,152 +2823,1155 @@ def setLayerSymbologyFromMapboxStyle(layer, style, sprites, add):
                                 symbolLayer = _svgFillSymbolLayer(outlineColor, fillPattern, sprites)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateRangeSymbol(idx, symbol)
+                                renderer.updateRangeSymbol(idx, symbol)
                     else:
                         if fillPattern is None:
                             symbol = _fillSymbol(color, outlineColor, translate, opacity)
                         else:
-                            symbol = _svgFillSymbol(outlineColor, fillPattern, sprites, opacity)
+                            symbol = _svgFillSymbol(outlineColor, opacity, fillPattern, sprites)
                         ranges.append(QgsRendererRangeV2(minValue, maxValue, symbol, rangeName))
                 if not add:
-                    renderer = QgsGraduatedSymbolRendererV2(style["paint"]["fill-color"]["property"], ranges)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsGraduatedSymbolRendererV2(var["property"], ranges)
         else:
-            outlineColor = style["paint"]["fill-outline-color"]
-            try:
-                translate = style["paint"]["fill-translate"]
-            except:
-                translate = 0
-            opacity = style["paint"]["fill-opacity"]
-            try:
-                fillPattern = style["paint"]["fill-pattern"]
-            except KeyError:
-                fillPattern = None
-                color = style["paint"]["fill-color"]
+            color, outlineColor, translate, opacity, fillPattern = fillProperties(0)
             if add:
-                symbol = layer.rendererV2().symbol().clone()
+                symbol = renderer.symbol().clone()
                 if fillPattern is None:
                     symbolLayer = _fillSymbolLayer(color, outlineColor, translate)
                 else:
                     symbolLayer = _svgFillSymbolLayer(outlineColor, fillPattern, sprites)
                 if symbolLayer is not None:
                     symbol.appendSymbolLayer(symbolLayer)
-                    layer.rendererV2().setSymbol(symbol)
+                    renderer.setSymbol(symbol)
             else:
-                symbol = _fillSymbol(color, outlineColor, translate, opacity)
-                layer.setRendererV2(QgsSingleSymbolRendererV2(symbol))
+                if fillPattern is None:
+                    symbol = _fillSymbol(color, outlineColor, translate, opacity)
+                else:
+                    symbol = _svgFillSymbol(outlineColor, opacity, fillPattern, sprites)
+                renderer = QgsSingleSymbolRendererV2(symbol)
     elif style["type"] == "symbol":
-        if isinstance(style["paint"]["icon-image"], dict):
-            if style["paint"]["icon-image"]["type"] == "categorical":
+        # icon-image is a layout property, but older exports wrote it as a paint one
+        iconImage = layout.get("icon-image", paint.get("icon-image"))
+        if iconImage is None:
+            return renderer
+        if isinstance(iconImage, dict):
+            if iconImage.get("type") == "categorical":
                 categories = []
-                for i, stop in enumerate(style["paint"]["icon-image"]["stops"]):
+                for i, stop in enumerate(iconImage["stops"]):
                     value = stop[0]
                     if add:
-                        idx, cat = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, cat = index.get(_categoryLabel(style, value), (-1, None))
+                        if idx != -1:
                             symbol = cat.symbol().clone()
                             symbolLayer = _svgMarkerSymbolLayer(stop[1], sprites)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateCategorySymbol(idx, symbol)
+                                renderer.updateCategorySymbol(idx, symbol)
                     else:
                         symbol = _svgMarkerSymbol(stop[1], sprites)
-                        categories.append(QgsRendererCategoryV2(value, symbol, str(value)))
+                        categories.append(QgsRendererCategoryV2(value, symbol, _categoryLabel(style, value)))
                 if not add:
-                    renderer = QgsCategorizedSymbolRendererV2(style["paint"]["icon-image"]["property"], categories)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsCategorizedSymbolRendererV2(iconImage["property"], categories)
             else:
                 ranges = []
-                for i, stop in enumerate(style["paint"]["icon-image"]["stops"]):
+                for i, stop in enumerate(iconImage["stops"]):
                     minValue = stop[0]
                     try:
-                        maxValue = style["paint"]["icon-image"]["stops"][i+1][0]
+                        maxValue = iconImage["stops"][i+1][0]
                     except:
                         maxValue = 100000000000
                     rangeName = str(minValue) + "-" + str(maxValue)
                     if add:
-                        idx, rang = _getCategoryOrRange(layer, str(value))
-                        if idx != 1:
+                        idx, rang = index.get(rangeName, (-1, None))
+                        if idx != -1:
                             symbol = rang.symbol().clone()
                             symbolLayer = _svgMarkerSymbolLayer(stop[1], sprites)
                             if symbolLayer is not None:
                                 symbol.appendSymbolLayer(symbolLayer)
-                                layer.rendererV2().updateRangeSymbol(idx, symbol)
+                                renderer.updateRangeSymbol(idx, symbol)
                     else:
                         symbol = _svgMarkerSymbol(stop[1], sprites)
                         ranges.append(QgsRendererRangeV2(minValue, maxValue, symbol, rangeName))
                 if not add:
-                    renderer = QgsGraduatedSymbolRendererV2(style["paint"]["icon-image"]["property"], ranges)
-                    layer.setRendererV2(renderer)
+                    renderer = QgsGraduatedSymbolRendererV2(iconImage["property"], ranges)
         else:
             if add:
-                symbol = layer.rendererV2().symbol().clone()
-                symbolLayer = _svgMarkerSymbolLayer(style["paint"]["icon-image"], sprites)
+                symbol = renderer.symbol().clone()
+                symbolLayer = _svgMarkerSymbolLayer(iconImage, sprites)
                 if symbolLayer is not None:
                     symbol.appendSymbolLayer(symbolLayer)
-                    layer.rendererV2().setSymbol(symbol)
+                    renderer.setSymbol(symbol)
             else:
-                symbol = _svgMarkerSymbol(style["paint"]["icon-image"], sprites)
-                layer.setRendererV2(QgsSingleSymbolRendererV2(symbol))
+                symbol = _svgMarkerSymbol(iconImage, sprites)
+                renderer = QgsSingleSymbolRendererV2(symbol)
 
-    iface.legendInterface().refreshLayerSymbology(layer)
-    layer.triggerRepaint()
+    return renderer
+
+def _setLayerScaleVisibilityFromMapboxStyle(layer, style):
+    if "minzoom" in style or "maxzoom" in style:
+        layer.setScaleBasedVisibility(True)
+        layer.setMinimumScale(_toScale(float(style.get("maxzoom", MAX_ZOOM))))
+        layer.setMaximumScale(_toScale(float(style.get("minzoom", 0))))
 
 def setLayerLabelingFromMapboxStyle(layer, style):
     palyr = QgsPalLayerSettings()
     palyr.readFromLayer(layer)
     palyr.enabled = True
-    palyr.fieldName = style["layout"]["text-field"].replace("{", "").replace("}", "")
-    offsets = style["layout"]["text-offset"].split(",")
+    layout = style.get("layout", {})
+    paint = style.get("paint", {})
+    textField = layout["text-field"]
+    if isinstance(textField, dict):
+        cases = " ".join("WHEN \"%s\" = %s THEN '%s'" % (textField["property"], code,
+                                                         unicode(text).replace("'", "''"))
+                         for code, text in textField["stops"])
+        palyr.fieldName = "CASE %s END" % cases
+        palyr.isExpression = True
+    else:
+        palyr.fieldName = textField.replace("{", "").replace("}", "")
+    offsets = layout.get("text-offset", [0, 0])
+    if isinstance(offsets, basestring):
+        offsets = offsets.split(",")
     palyr.xOffset = float(offsets[0])
-    palyr.yOffset = float(offsets[0])
-    if "minzoom" in style:
-        palyr.scaleMin = _toScale(float(style["minzoom"]))
-        palyr.scaleMax = _toScale(float(style["maxzoom"]))
+    palyr.yOffset = float(offsets[1])
+    if "minzoom" in style or "maxzoom" in style:
+        palyr.scaleMin = _toScale(float(style.get("maxzoom", MAX_ZOOM)))
+        palyr.scaleMax = _toScale(float(style.get("minzoom", 0)))
         palyr.scaleVisibility = True
         palyr.placement = QgsPalLayerSettings.OverPoint
 
     #palyr.setDataDefinedProperty(QgsPalLayerSettings.OffsetXY,True,True,str(offsets), "")
-    palyr.setDataDefinedProperty(QgsPalLayerSettings.Size,True,True,str(style["layout"]["text-size"]), "")
-    palyr.setDataDefinedProperty(QgsPalLayerSettings.Color,True,True,str(style["paint"]["text-color"]), "")
-
-    if "text-halo-color" in style["layout"]:
-        palyr.setDataDefinedProperty(QgsPalLayerSettings.BufferColor,True,True,str(style["layout"]["text-halo-color"]), "")
-    if "text-halo-width" in style["layout"]:
-        palyr.setDataDefinedProperty(QgsPalLayerSettings.BufferSize,True,True,str(style["layout"]["text-halo-width"]), "")
+    palyr.setDataDefinedProperty(QgsPalLayerSettings.Size,True,True,str(layout.get("text-size", 16)), "")
+    palyr.setDataDefinedProperty(QgsPalLayerSettings.Color,True,True,str(paint.get("text-color", DEFAULT_COLOR)), "")
+
+    # halo properties are paint properties, but older exports wrote them in the layout
+    haloColor = paint.get("text-halo-color", layout.get("text-halo-color"))
+    haloWidth = paint.get("text-halo-width", layout.get("text-halo-width"))
+    if haloColor is not None:
+        palyr.setDataDefinedProperty(QgsPalLayerSettings.BufferColor,True,True,str(haloColor), "")
+    if haloWidth is not None:
+        palyr.setDataDefinedProperty(QgsPalLayerSettings.BufferSize,True,True,str(haloWidth), "")
     palyr.writeToLayer(layer)
 
-def openProjectFromMapboxFile(mapboxFile):
-    iface.newProject()
+class _JsonStreamReader(object):
+    """Minimal incremental JSON reader. It decodes values one at a time
+    from a file, reading only as much of it as needed, and lets the caller
+    walk objects and arrays without decoding them completely.
+    """
+
+    def __init__(self, f, chunkSize = 65536):
+        self.f = f
+        self.chunkSize = chunkSize
+        self.buf = u""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        # read at least as much as is already buffered, so decoding a large
+        # value takes a linear number of retries
+        data = self.f.read(max(self.chunkSize, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        self.eof = not data
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in u" \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return u""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '%s' at position %i" % (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._read():
+                    raise
+                continue
+            # a number at the end of the buffer might continue in the file, even
+            # if it is followed by the start of a fraction or an exponent ("1.", "1e-")
+            if (not self.eof and isinstance(obj, (int, long, float)) and not isinstance(obj, bool)
+                    and len(self.buf) - end <= 2 and self.buf[end:].strip(u".eE+-") == u""):
+                self._read()
+                continue
+            self.pos = end
+            return obj
+
+    def _members(self, start, end, isObject):
+        self.expect(start)
+        if self.peek() == end:
+            self.pos += 1
+            return
+        while True:
+            if isObject:
+                key = self.value()
+                self.expect(u":")
+                yield key
+            else:
+                yield None
+            char = self.peek()
+            self.pos += 1
+            if char == end:
+                return
+            if char != u",":
+                raise ValueError("Expected ',' or '%s' at position %i" % (end, self.pos))
+
+    def keys(self):
+        """Iterates the keys of an object. The caller must consume the
+        value of each key before asking for the next one.
+        """
+        return self._members(u"{", u"}", True)
+
+    def elements(self):
+        """Iterates the elements of an array, which must be consumed by
+        the caller.
+        """
+        return self._members(u"[", u"]", False)
+
+INLINE_BATCH_SIZE = 1000
+
+def _readMapboxFile(mapboxFile):
+    """Reads a Mapbox GL file. Inline GeoJSON sources are not loaded in
+    memory. Their features are streamed in batches to a GeoJSON file in a
+    folder next to the Mapbox GL file, and the 'data' of the source is
+    replaced with the relative path to that file.
+    """
+    dataFolder = os.path.splitext(mapboxFile)[0] + "_data"
+    project = OrderedDict()
+    with codecs.open(mapboxFile, encoding="utf-8") as f:
+        reader = _JsonStreamReader(f)
+        for key in reader.keys():
+            if key != "sources":
+                project[key] = reader.value()
+                continue
+            project["sources"] = OrderedDict()
+            for name in reader.keys():
+                source = OrderedDict()
+                for prop in reader.keys():
+                    if prop == "data" and reader.peek() == u"{":
+                        QDir().mkpath(dataFolder)
+                        filename = safeName(name) + ".geojson"
+                        _streamFeatureCollection(reader, os.path.join(dataFolder, filename))
+                        source["data"] = "%s/%s" % (os.path.basename(dataFolder), filename)
+                    else:
+                        source[prop] = reader.value()
+                project["sources"][name] = source
+    return project
+
+def _streamFeatureCollection(reader, path):
+    with codecs.open(path, "w", encoding="utf-8") as out:
+        out.write(u'{"type":"FeatureCollection","features":[')
+        first = True
+        for key in reader.keys():
+            if key != "features":
+                reader.value()
+                continue
+            batch = []
+            for _ in reader.elements():
+                batch.append(json.dumps(reader.value(), ensure_ascii=False))
+                if len(batch) == INLINE_BATCH_SIZE:
+                    out.write((u"" if first else u",") + u",".join(batch))
+                    first = False
+                    batch = []
+            if batch:
+                out.write((u"" if first else u",") + u",".join(batch))
+                first = False
+        out.write(u"]}")
+
+def _pbfFields(data):
+    """Iterates the (field number, value) pairs of a protocol buffers
+    message. Length-delimited values are returned as byte strings, and
+    fixed-size ones as raw bytes too, so callers can unpack them.
+    """
+    data = bytearray(data)
+    pos = 0
+    while pos < len(data):
+        key, pos = _readVarint(data, pos)
+        field, wireType = key >> 3, key & 7
+        if wireType == 0:
+            value, pos = _readVarint(data, pos)
+        elif wireType == 1:
+            value, pos = str(data[pos:pos + 8]), pos + 8
+        elif wireType == 2:
+            length, pos = _readVarint(data, pos)
+            value, pos = str(data[pos:pos + length]), pos + length
+        elif wireType == 5:
+            value, pos = str(data[pos:pos + 4]), pos + 4
+        else:
+            raise ValueError("Unsupported protocol buffers wire type: %i" % wireType)
+        yield field, value
+
+def _readVarint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def _packedVarints(data):
+    data = bytearray(data)
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = _readVarint(data, pos)
+        values.append(value)
+    return values
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def _decodeTileValue(data):
+    for field, value in _pbfFields(data):
+        if field == 1:
+            return value.decode("utf-8")
+        elif field == 2:
+            return struct.unpack("<f", value)[0]
+        elif field == 3:
+            return struct.unpack("<d", value)[0]
+        elif field == 4:
+            return value - (1 << 64) if value >= (1 << 63) else value
+        elif field == 5:
+            return value
+        elif field == 6:
+            return _zigzag(value)
+        elif field == 7:
+            return bool(value)
+    return None
+
+def _decodeTileGeometry(geomType, commands):
+    """Decodes the commands of a vector tile feature geometry into a list
+    of parts, each of them a list of (x, y) tuples in tile coordinates.
+    Polygons are returned as a list of polygons, each of them a list of
+    rings, with the exterior ring first.
+    """
+    x = y = 0
+    parts = []
+    current = None
+    i = 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if command in [1, 2]:
+            for _ in xrange(count):
+                x += _zigzag(commands[i])
+                y += _zigzag(commands[i + 1])
+                i += 2
+                if command == 1:
+                    current = [(x, y)]
+                    parts.append(current)
+                else:
+                    current.append((x, y))
+        elif command == 7 and current:
+            current.append(current[0])
+    if geomType != 3:
+        return parts
+    polygons = []
+    for ring in parts:
+        if _ringArea(ring) > 0 or not polygons:
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+    return polygons
+
+def _decodeVectorTile(data, z, x, y):
+    """Decodes a Mapbox vector tile and returns a dict with layer names as
+    keys, and lists of (geometry type, WKT in EPSG:4326, properties) tuples
+    as values.
+    """
+    if data[:2] == "\x1f\x8b":
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
     layers = {}
-    labels = []
-    with open(mapboxFile) as f:
-        project = json.load(f)
+    for field, layerData in _pbfFields(data):
+        if field != 3:
+            continue
+        name = None
+        keys = []
+        values = []
+        features = []
+        extent = 4096
+        for layerField, value in _pbfFields(layerData):
+            if layerField == 1:
+                name = value.decode("utf-8")
+            elif layerField == 2:
+                features.append(value)
+            elif layerField == 3:
+                keys.append(value.decode("utf-8"))
+            elif layerField == 4:
+                values.append(_decodeTileValue(value))
+            elif layerField == 5:
+                extent = value
+        n = 2.0 ** z
+        def toLonLat(point):
+            lon = (x + point[0] / float(extent)) / n * 360.0 - 180.0
+            lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + point[1] / float(extent)) / n))))
+            return "%.7f %.7f" % (lon, lat)
+        decoded = []
+        for featureData in features:
+            tags = []
+            geomType = 0
+            commands = []
+            for featureField, value in _pbfFields(featureData):
+                if featureField == 2:
+                    tags = _packedVarints(value)
+                elif featureField == 3:
+                    geomType = value
+                elif featureField == 4:
+                    commands = _packedVarints(value)
+            parts = _decodeTileGeometry(geomType, commands)
+            if not parts:
+                continue
+            if geomType == 1:
+                wkt = "MULTIPOINT(%s)" % ",".join("(%s)" % toLonLat(p[0]) for p in parts)
+            elif geomType == 2:
+                wkt = "MULTILINESTRING(%s)" % ",".join("(%s)" % ",".join(toLonLat(p) for p in part)
+                                                       for part in parts)
+            elif geomType == 3:
+                wkt = "MULTIPOLYGON(%s)" % ",".join("(%s)" % ",".join("(%s)" % ",".join(toLonLat(p) for p in ring)
+                                                                      for ring in polygon)
+                                                    for polygon in parts)
+            else:
+                continue
+            properties = dict((keys[tags[i]], values[tags[i + 1]]) for i in xrange(0, len(tags) - 1, 2))
+            decoded.append((geomType, wkt, properties))
+        layers[name] = decoded
+    return layers
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+def _pbfDouble(field, value):
+    return _varint((field << 3) | 1) + struct.pack("<d", value)
+
+def _encodeTileValue(value):
+    if isinstance(value, bool):
+        return _pbfVarint(7, int(value))
+    elif isinstance(value, (int, long)):
+        return _pbfSVarint(6, value) if value < 0 else _pbfVarint(5, value)
+    elif isinstance(value, float):
+        return _pbfDouble(3, value)
+    return _pbfString(1, unicode(value))
+
+def _encodeTileGeometry(geomType, parts):
+    """Encodes parts in tile coordinates, in the format returned by
+    _decodeTileGeometry, into vector tile geometry commands. Repeated
+    points are removed, and so are lines and rings left with too few
+    points. Polygon rings are oriented as required by the specification.
+    Returns an empty list if nothing is left.
+    """
+    commands = []
+    position = [0, 0]
+    def command(id, count):
+        commands.append((id & 7) | (count << 3))
+    def moveTo(points):
+        for px, py in points:
+            dx, dy = px - position[0], py - position[1]
+            commands.append((dx << 1) ^ (dx >> 63))
+            commands.append((dy << 1) ^ (dy >> 63))
+            position[0], position[1] = px, py
+    def unique(points):
+        result = []
+        for point in points:
+            if not result or point != result[-1]:
+                result.append(point)
+        return result
+    if geomType == 1:
+        points = [part[0] for part in parts]
+        if points:
+            command(1, len(points))
+            moveTo(points)
+    elif geomType == 2:
+        for line in parts:
+            line = unique(line)
+            if len(line) < 2:
+                continue
+            command(1, 1)
+            moveTo(line[:1])
+            command(2, len(line) - 1)
+            moveTo(line[1:])
+    else:
+        for polygon in parts:
+            for i, ring in enumerate(polygon):
+                ring = unique(ring)
+                if len(ring) > 1 and ring[0] == ring[-1]:
+                    ring = ring[:-1]
+                if len(ring) < 3:
+                    if i == 0:
+                        break
+                    continue
+                area = _ringArea(ring + ring[:1])
+                if area == 0:
+                    continue
+                if (area > 0) != (i == 0):
+                    ring.reverse()
+                command(1, 1)
+                moveTo(ring[:1])
+                command(2, len(ring) - 1)
+                moveTo(ring[1:])
+                command(7, 1)
+    return commands
+
+def _encodeVectorTile(layers):
+    """Encodes a Mapbox vector tile. 'layers' is a list of (name, features)
+    tuples, with features as (id, geometry type, parts, properties) tuples,
+    and parts in the format returned by _decodeTileGeometry.
+    """
+    data = []
+    for name, features in layers:
+        keys = OrderedDict()
+        values = OrderedDict()
+        encodedFeatures = []
+        for fid, geomType, parts, properties in features:
+            commands = _encodeTileGeometry(geomType, parts)
+            if not commands:
+                continue
+            tags = []
+            for key, value in properties.iteritems():
+                if value is None or isinstance(value, QPyNullVariant):
+                    continue
+                encodedValue = _encodeTileValue(value)
+                tags.append(keys.setdefault(key, len(keys)))
+                tags.append(values.setdefault(encodedValue, len(values)))
+            feature = _pbfVarint(1, fid) if fid is not None and fid >= 0 else ""
+            feature += _pbfBytes(2, "".join(_varint(t) for t in tags))
+            feature += _pbfVarint(3, geomType)
+            feature += _pbfBytes(4, "".join(_varint(c) for c in commands))
+            encodedFeatures.append(_pbfBytes(2, feature))
+        if not encodedFeatures:
+            continue
+        layer = (_pbfVarint(15, 2) + _pbfString(1, name) + "".join(encodedFeatures)
+                 + "".join(_pbfString(3, key) for key in keys)
+                 + "".join(_pbfBytes(4, value) for value in values)
+                 + _pbfVarint(5, TILE_EXTENT))
+        data.append(_pbfBytes(3, layer))
+    return "".join(data)
+
+def _tileBounds(z, x, y):
+    resolution = 2 * WEB_MERCATOR_HALF_SIZE / (1 << z)
+    xmin = -WEB_MERCATOR_HALF_SIZE + x * resolution
+    ymax = WEB_MERCATOR_HALF_SIZE - y * resolution
+    return QgsRectangle(xmin, ymax - resolution, xmin + resolution, ymax)
+
+def _tileFeatures(layer, z, x, y):
+    """Returns the features of a layer in a tile, as expected by
+    _encodeVectorTile. Features are selected with a spatial filter, so the
+    spatial index of the provider is used, and only the attributes needed
+    for styling are kept. Geometries are clipped to the tile (plus a
+    buffer) and simplified to the tile resolution.
+    """
+    bounds = _tileBounds(z, x, y)
+    scale = TILE_EXTENT / bounds.width()
+    margin = TILE_BUFFER / scale
+    clip = QgsRectangle(bounds.xMinimum() - margin, bounds.yMinimum() - margin,
+                        bounds.xMaximum() + margin, bounds.yMaximum() + margin)
+    mercator = QgsCoordinateReferenceSystem("EPSG:3857")
+    toLayer = QgsCoordinateTransform(mercator, layer.crs())
+    toTile = QgsCoordinateTransform(layer.crs(), mercator)
+    attributes = _styleAttributes(layer)
+    request = QgsFeatureRequest().setFilterRect(toLayer.transformBoundingBox(clip))
+    request.setSubsetOfAttributes(attributes, layer.pendingFields())
+    geomType = {QGis.Point: 1, QGis.Line: 2, QGis.Polygon: 3}.get(layer.geometryType())
+    if geomType is None:
+        return []
+    clipGeom = QgsGeometry.fromRect(clip)
+    toPixel = lambda p: (int(round((p.x() - bounds.xMinimum()) * scale)),
+                         int(round((bounds.yMaximum() - p.y()) * scale)))
+    features = []
+    for feature in layer.getFeatures(request):
+        geom = feature.geometry()
+        if geom is None or geom.isGeosEmpty():
+            continue
+        geom = QgsGeometry(geom)
+        geom.transform(toTile)
+        if geomType == 1:
+            points = geom.asMultiPoint() if geom.isMultipart() else [geom.asPoint()]
+            parts = [[toPixel(p)] for p in points if clip.contains(p)]
+        else:
+            geom = geom.intersection(clipGeom)
+            if geom is None or geom.isGeosEmpty():
+                continue
+            geom = geom.simplify(1 / scale) or geom
+            if geomType == 2:
+                lines = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+                parts = [[toPixel(p) for p in line] for line in lines]
+            else:
+                polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+                parts = [[[toPixel(p) for p in ring] for ring in polygon] for polygon in polygons]
+        if parts:
+            properties = dict((name, feature[name]) for name in attributes)
+            features.append((feature.id(), geomType, parts, properties))
+    return features
+
+class _MemorySink(object):
+    """Keeps the exported files in a dict, with names as keys"""
+
+    def __init__(self):
+        self.files = {}
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.files[name] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+class TileServer(object):
+    """A local HTTP server to preview layers in the sample application
+    without exporting them. It serves a Mapbox GL style, sprites and vector
+    tiles generated on demand from the layers (all the layers in the map
+    canvas if none are passed), at http://localhost:<port>/index.html.
+
+    Snapshots of the layers are taken when the server is started, and
+    requests are served one at a time from a background thread. Call
+    refresh() to serve the current state of the layers. Up to 'cacheSize'
+    tiles are kept in memory, and responses are gzipped and have an ETag.
+    Tiles above 'maxzoom' or outside the tile grid are not found (404).
+    """
+
+    def __init__(self, qgislayers = None, port = 8000, cacheSize = 1024, maxzoom = 20):
+        import threading
+        self.qgislayers = qgislayers
+        self.port = port
+        self.cacheSize = cacheSize
+        self.maxzoom = maxzoom
+        self.layers = []
+        self.style = None
+        self.files = {}
+        self._cache = OrderedDict()
+        # guards the state replaced by refresh, which the server thread reads
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return "http://localhost:%i/index.html" % self.port
+
+    def start(self):
+        import BaseHTTPServer
+        import threading
+        self.refresh()
+        tileServer = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                tileServer._handle(self)
+            def log_message(self, format, *args):
+                pass
+        self._server = BaseHTTPServer.HTTPServer(("localhost", self.port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def refresh(self):
+        """Takes new snapshots of the layers and creates the style again.
+        It must be called in the main thread."""
+        qgislayers = [layer for layer in (self.qgislayers or qgisLayers())
+                      if layer.type() == layer.VectorLayer]
+        sink = _MemorySink()
+        styleLayers, sprites = createLayers(sink, qgislayers)
+        for styleLayer in styleLayers:
+            styleLayer["source-layer"] = _styleLayerOwner(styleLayer)
+            styleLayer["source"] = "qgis"
+            styleLayer.pop("metadata", None)
+        center, zoom = _canvasView()
+        style = {"version": 8,
+                 "name": "QGIS project",
+                 "glyphs": "mapbox://fonts/mapbox/{fontstack}/{range}.pbf",
+                 "sources": {"qgis": {"type": "vector", "maxzoom": self.maxzoom}},
+                 "layers": styleLayers,
+                 "center": center,
+                 "zoom": zoom}
+        if sprites:
+            style["sprite"] = "spriteSheet"
+        layers = [(safeName(layer.name()), _layerSnapshot(layer)) for layer in qgislayers]
+        with self._lock:
+            self.style = style
+            self.layers = layers
+            self.files = sink.files
+            self._cache = OrderedDict()
+
+    def tile(self, z, x, y):
+        """Returns a gzipped vector tile with the layers visible at zoom
+        level 'z'"""
+        key = (z, x, y)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)
+                return self._cache[key]
+            cache, layers = self._cache, self.layers
+        # the tile is created without holding the lock, so refresh is not
+        # blocked, and it is only cached if the layers were not refreshed
+        tileLayers = []
+        for name, layer in layers:
+            zooms = _layerZooms(layer)
+            if z < math.floor(zooms.get("minzoom", 0)) or z >= zooms.get("maxzoom", MAX_ZOOM + 1):
+                continue
+            tileLayers.append((name, _tileFeatures(layer, z, x, y)))
+        data = _gzip(_encodeVectorTile(tileLayers))
+        with self._lock:
+            cache[key] = data
+            while len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+        return data
+
+    def _handle(self, request):
+        path = request.path.split("?")[0].lstrip("/") or "index.html"
+        tileMatch = re.match(r"tiles/(\d+)/(\d+)/(\d+)\.pbf$", path)
+        contentType = "application/octet-stream"
+        gzipped = False
+        with self._lock:
+            style, files = self.style, self.files
+        if tileMatch:
+            z, x, y = [int(v) for v in tileMatch.groups()]
+            if z > self.maxzoom or x >= 1 << z or y >= 1 << z:
+                request.send_error(404)
+                return
+            data = self.tile(z, x, y)
+            contentType = "application/x-protobuf"
+            gzipped = True
+        elif path == "mapbox.json":
+            host = request.headers.get("Host", "localhost:%i" % self.port)
+            style = dict(style)
+            style["sources"] = {"qgis": dict(style["sources"]["qgis"],
+                                             tiles=["http://%s/tiles/{z}/{x}/{y}.pbf" % host])}
+            data = json.dumps(style)
+            contentType = "application/json"
+        elif path in files:
+            data = files[path]
+            contentType = "image/png" if path.endswith(".png") else "application/json"
+        else:
+            appPath = os.path.join(os.path.dirname(__file__), "sampleapp", *path.split("/"))
+            if ".." in path.split("/") or not os.path.isfile(appPath):
+                request.send_error(404)
+                return
+            with open(appPath, "rb") as f:
+                data = f.read()
+            contentType = {".html": "text/html", ".js": "application/javascript"}.get(
+                                    os.path.splitext(path)[1], contentType)
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if request.headers.get("If-None-Match") == etag:
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+        acceptsGzip = "gzip" in request.headers.get("Accept-Encoding", "")
+        if gzipped and not acceptsGzip:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            gzipped = False
+        elif not gzipped and acceptsGzip and not contentType.startswith("image/"):
+            data = _gzip(data)
+            gzipped = True
+        request.send_response(200)
+        request.send_header("Content-Type", contentType)
+        request.send_header("Content-Length", str(len(data)))
+        request.send_header("ETag", etag)
+        request.send_header("Access-Control-Allow-Origin", "*")
+        if gzipped:
+            request.send_header("Content-Encoding", "gzip")
+        request.end_headers()
+        request.wfile.write(data)
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class VectorTileSource(object):
+    """Vector tiles read from a local MBTiles file or a z/x/y folder.
+
+    Decoded tiles are kept in a least-recently-used memory cache of
+    'memoryTiles' tiles, and in a disk cache in 'cacheFolder', so each tile
+    is decoded only once. Tiles can be read from any thread.
+    """
+
+    def __init__(self, location, cacheFolder, minzoom = 0, maxzoom = 14, memoryTiles = 256):
+        import sqlite3
+        import threading
+        self.location = location
+        self.cacheFolder = cacheFolder
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.memoryTiles = memoryTiles
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if location.lower().endswith(".mbtiles"):
+            self._db = sqlite3.connect(location, check_same_thread=False)
+
+    def _rawTile(self, z, x, y):
+        if self._db is not None:
+            row = self._db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? "
+                                   "AND tile_column=? AND tile_row=?",
+                                   (z, x, (1 << z) - 1 - y)).fetchone()
+            return str(row[0]) if row else None
+        path = self.location.replace("{z}", str(z)).replace("{x}", str(x)).replace("{y}", str(y))
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+        return None
+
+    def tile(self, z, x, y):
+        with self._lock:
+            return self._tile(z, x, y)
+
+    def _tile(self, z, x, y):
+        key = (z, x, y)
+        if key in self._cache:
+            self._cache[key] = self._cache.pop(key)
+            return self._cache[key]
+        cachePath = os.path.join(self.cacheFolder, str(z), str(x), "%i.json" % y)
+        if os.path.exists(cachePath):
+            with open(cachePath) as f:
+                layers = json.load(f)
+        else:
+            data = self._rawTile(z, x, y)
+            layers = _decodeVectorTile(data, z, x, y) if data else {}
+            QDir().mkpath(os.path.dirname(cachePath))
+            with open(cachePath, "w") as f:
+                json.dump(layers, f)
+        self._cache[key] = layers
+        if len(self._cache) > self.memoryTiles:
+            self._cache.popitem(last=False)
+        return layers
+
+MAX_VISIBLE_TILES = 64
+
+def _tilesForExtent(extent, z):
+    n = 1 << z
+    def tileX(lon):
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+    def tileY(lat):
+        lat = max(-85.0511, min(85.0511, lat))
+        rad = math.radians(lat)
+        return min(n - 1, max(0, int((1 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi) / 2 * n)))
+    return [(z, x, y) for x in xrange(tileX(extent.xMinimum()), tileX(extent.xMaximum()) + 1)
+                      for y in xrange(tileY(extent.yMaximum()), tileY(extent.yMinimum()) + 1)]
+
+_geometryTypes = {"fill": (3, "MultiPolygon"), "line": (2, "MultiLineString"),
+                  "symbol": (1, "MultiPoint"), "circle": (1, "MultiPoint")}
+
+class _TileLoadThread(QThread):
+
+    def __init__(self, source, sourceLayer, geomType, tiles):
+        QThread.__init__(self)
+        self.source = source
+        self.sourceLayer = sourceLayer
+        self.geomType = geomType
+        self.tiles = tiles
+        self.features = []
+        self.error = None
+
+    def run(self):
+        try:
+            for tile in self.tiles:
+                for geomType, wkt, properties in self.source.tile(*tile).get(self.sourceLayer, []):
+                    if geomType == self.geomType:
+                        self.features.append((wkt, properties))
+        except Exception, e:
+            self.error = traceback.format_exc()
+
+def _propertyTypes(properties):
+    """Returns a dict with the field type for each property name in the
+    passed property dicts: Double if all its values are numbers, and String
+    otherwise"""
+    types = {}
+    for props in properties:
+        for name, value in props.iteritems():
+            numeric = isinstance(value, (int, long, float))
+            if numeric and types.get(name, QVariant.Double) == QVariant.Double:
+                types[name] = QVariant.Double
+            else:
+                types[name] = QVariant.String
+    return types
+
+class VectorTileLayer(object):
+    """Memory layer with the features of one layer of a vector tile source
+    in the tiles covering the current map canvas extent. Features are
+    reloaded when the canvas extent changes. Tiles are decoded in a
+    background thread, and only the features of the last requested extent
+    are added to the layer.
+    """
+
+    def __init__(self, source, sourceLayer, styleType, name):
+        self.source = source
+        self.sourceLayer = sourceLayer
+        self.geomType, wkbType = _geometryTypes[styleType]
+        self.layer = QgsVectorLayer("%s?crs=EPSG:4326" % wkbType, name, "memory")
+        self.tiles = None
+        self._thread = None
+        iface.mapCanvas().extentsChanged.connect(self.refresh)
+        QgsMapLayerRegistry.instance().layerWillBeRemoved.connect(self._layerRemoved)
+
+    def _layerRemoved(self, layerId):
+        if layerId == self.layer.id():
+            iface.mapCanvas().extentsChanged.disconnect(self.refresh)
+            QgsMapLayerRegistry.instance().layerWillBeRemoved.disconnect(self._layerRemoved)
+            _vectorTileLayers.remove(self)
+            self.layer = None
+
+    def refresh(self):
+        canvas = iface.mapCanvas()
+        transform = QgsCoordinateTransform(canvas.mapSettings().destinationCrs(),
+                                           QgsCoordinateReferenceSystem("EPSG:4326"))
+        extent = transform.transform(canvas.extent())
+        z = int(round(_toZoomLevel(canvas.scale())))
+        z = max(self.source.minzoom, min(self.source.maxzoom, z))
+        tiles = _tilesForExtent(extent, z)
+        if len(tiles) > MAX_VISIBLE_TILES or tiles == self.tiles:
+            return
+        self.tiles = tiles
+        # if tiles are being loaded, the latest ones are loaded when they finish
+        if self._thread is None:
+            self._load()
+
+    def _load(self):
+        self._thread = _TileLoadThread(self.source, self.sourceLayer, self.geomType, self.tiles)
+        self._thread.finished.connect(self._loaded)
+        self._thread.start()
+
+    def _loaded(self):
+        thread = self._thread
+        self._thread = None
+        if self.layer is None:
+            return
+        if thread.tiles != self.tiles:
+            self._load()
+            return
+        if thread.error is not None:
+            QgsMessageLog.logMessage("ERROR: " + thread.error, level=QgsMessageLog.CRITICAL)
+            return
+        features = thread.features
+        types = _propertyTypes(properties for _, properties in features)
+        provider = self.layer.dataProvider()
+        provider.deleteFeatures([f.id() for f in provider.getFeatures()])
+        # all features are replaced, so numeric fields that now have other
+        # values can be created again as string fields
+        existing = dict((f.name(), f.type()) for f in provider.fields())
+        changed = [name for name, fieldType in types.iteritems()
+                   if existing.get(name) == QVariant.Double and fieldType == QVariant.String]
+        if changed:
+            provider.deleteAttributes([provider.fields().indexFromName(name) for name in changed])
+            self.layer.updateFields()
+        newFields = [QgsField(name, fieldType) for name, fieldType in sorted(types.iteritems())
+                     if name not in existing or name in changed]
+        if newFields:
+            provider.addAttributes(newFields)
+            self.layer.updateFields()
+        fields = self.layer.pendingFields()
+        strings = set(f.name() for f in fields if f.type() == QVariant.String)
+        qgisFeatures = []
+        for wkt, properties in features:
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromWkt(wkt))
+            for name, value in properties.iteritems():
+                feature[name] = unicode(value) if name in strings and value is not None else value
+            qgisFeatures.append(feature)
+        provider.addFeatures(qgisFeatures)
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
+
+# keeps references to the layers, so they are updated while they are in the project
+_vectorTileLayers = []
+
+def _vectorTileSource(mapboxFile, name, source):
+    """Creates a VectorTileSource for a 'vector' source of a Mapbox GL file.
+    Only local tiles are supported, either in an MBTiles file ('url' with
+    an 'mbtiles://' prefix) or in a z/x/y folder (local 'tiles' template).
+    """
+    folder = os.path.dirname(mapboxFile)
+    if source.get("url", "").startswith("mbtiles://"):
+        location = source["url"][len("mbtiles://"):]
+    elif source.get("tiles") and "://" not in source["tiles"][0].replace("file://", ""):
+        location = source["tiles"][0].replace("file://", "")
+    else:
+        QgsMessageLog.logMessage("Vector source '%s' does not use local tiles. "
+                                 "Only MBTiles files and local tile folders are supported" % name,
+                                 level=QgsMessageLog.WARNING)
+        return None
+    location = os.path.join(folder, location)
+    cacheFolder = os.path.join(folder, ".tilecache", safeName(name))
+    return VectorTileSource(location, cacheFolder, source.get("minzoom", 0), source.get("maxzoom", 14))
+
+def _styledProperties(styles):
+    properties = []
+    for style in styles:
+        for group in ["paint", "layout"]:
+            for value in style.get(group, {}).values():
+                if isinstance(value, dict) and value.get("property") not in [None] + properties:
+                    properties.append(value["property"])
+    return properties
+
+def _toGeoPackage(path, indexedFields):
+    """Copies a vector file into a GeoPackage next to it, with a spatial
+    index and an attribute index for each of the passed fields, and returns
+    the path to the GeoPackage.
+    """
+    import sqlite3
+    gpkgPath = os.path.splitext(path)[0] + ".gpkg"
+    layer = QgsVectorLayer(path, "source", "ogr")
+    QgsVectorFileWriter.writeAsVectorFormat(layer, gpkgPath, "utf-8", layer.crs(), "GPKG")
+    conn = sqlite3.connect(gpkgPath)
+    try:
+        table = conn.execute("SELECT table_name FROM gpkg_contents "
+                             "WHERE data_type = 'features'").fetchone()[0]
+        columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % table)]
+        for field in indexedFields:
+            if field in columns:
+                conn.execute('CREATE INDEX IF NOT EXISTS "idx_%s_%s" ON "%s" ("%s")'
+                             % (table, field, table, field))
+        conn.commit()
+    finally:
+        conn.close()
+    return gpkgPath
+
+def _loadVectorLayer(path, name, indexedFields = None):
+    if indexedFields is not None:
+        path = _toGeoPackage(path, indexedFields)
+    layer = QgsVectorLayer(path, name, "ogr")
+    layer.extent()
+    # layers are created in worker threads, but used from the main one
+    layer.moveToThread(QCoreApplication.instance().thread())
+    return layer
+
+def openProjectFromMapboxFile(mapboxFile, feedback = None, threads = 4, geopackage = False):
+    """Opens a Mapbox GL file as a new QGIS project.
+
+    Data sources are opened concurrently in a pool of 'threads' worker
+    threads, while layers are styled and added to the project in the main
+    thread, in the order of the style, as they become available. If a
+    Feedback object is passed, progress is reported to it, and the import
+    stops when it is canceled, keeping the layers already added.
+
+    If 'geopackage' is True, each GeoJSON source is copied into a GeoPackage
+    next to it, with a spatial index and indexes on the styled properties,
+    and layers are loaded from that copy.
+    """
+    from multiprocessing.pool import ThreadPool
+    feedback = feedback or Feedback()
+    iface.newProject()
+    project = _readMapboxFile(mapboxFile)
     if "sprite" in project:
-        sprites = os.path.join(os.path.dirname(mapboxFile), project["sprite"])
+        sprites = SpriteSheet(os.path.join(os.path.dirname(mapboxFile), project["sprite"]))
     else:
         sprites = None
+    # style layers are grouped by the QGIS layer they belong to, so each
+    # layer is styled completely before being added to the project
+    groups = OrderedDict()
     for layer in project["layers"]:
-        layerType = project["sources"][layer["source"]]["type"]
-        if layerType.lower() == "geojson":
-            source = project["sources"][layer["source"]]["data"]
-            path = os.path.join(os.path.dirname(mapboxFile), source)
-            if layer["id"].startswith("txt"):
-                labels.append(layer)
+        # layers without a source, such as backgrounds, have no QGIS counterpart
+        layerSource = project.get("sources", {}).get(layer.get("source"))
+        layerType = layerSource.get("type", "").lower() if layerSource else None
+        if layerType not in ["geojson", "raster", "vector"]:
+            if layerSource is not None:
+                QgsMessageLog.logMessage("Layer '%s' uses a source of type '%s', which is not supported"
+                                         % (layer.get("id"), layerType), level=QgsMessageLog.WARNING)
+            continue
+        categoriesFile = layer.get("metadata", {}).get("qgis:categories")
+        if categoriesFile:
+            with codecs.open(os.path.join(os.path.dirname(mapboxFile), categoriesFile), encoding="utf-8") as f:
+                layer["metadata"]["qgis:categoryLabels"] = json.load(f)["labels"]
+        if layerType == "geojson":
+            source = layer.get("metadata", {}).get("qgis:layer", layer["source"])
+            groups.setdefault(source, []).append(layer)
+        elif layerType == "raster":
+            groups[layer["id"]] = [layer]
+        elif layerType == "vector":
+            groups.setdefault("%s/%s" % (layer["source"], layer.get("source-layer")), []).append(layer)
+    sourceType = lambda styles: project["sources"][styles[0]["source"]]["type"].lower()
+    pool = ThreadPool(threads)
+    pending = {}
+    tileSources = {}
+    for source, styles in groups.iteritems():
+        if sourceType(styles) == "vector":
+            name = styles[0]["source"]
+            if name not in tileSources:
+                tileSources[name] = _vectorTileSource(mapboxFile, name, project["sources"][name])
+        elif sourceType(styles) == "geojson":
+            path = os.path.join(os.path.dirname(mapboxFile), project["sources"][source]["data"])
+            symbologyStyles = [s for s in styles if not s["id"].startswith("txt")]
+            name = symbologyStyles[0]["id"] if symbologyStyles else source
+            indexedFields = _styledProperties(styles) if geopackage else None
+            pending[source] = pool.apply_async(_loadVectorLayer, (path, name, indexedFields))
+    pool.close()
+    for i, (source, styles) in enumerate(groups.iteritems()):
+        if feedback.isCanceled():
+            break
+        feedback.setProgress(100 * i / len(groups), "Loading layer '%s'" % source)
+        if sourceType(styles) == "raster":
+            layer = styles[0]
+            source = project["sources"][layer["source"]]
+            if source.get("url", "").startswith("mbtiles://"):
+                path = os.path.join(os.path.dirname(mapboxFile), source["url"][len("mbtiles://"):])
+                wmsLayer = QgsRasterLayer(path, layer["id"], "gdal")
+            elif source.get("tiles") and "://" not in source["tiles"][0]:
+                # a local z/x/y tile folder, opened with the XYZ support of the WMS provider
+                path = os.path.join(os.path.dirname(mapboxFile), source["tiles"][0])
+                url = "type=xyz&url=file://%s&zmin=%i&zmax=%i" % (path.replace(os.sep, "/"),
+                                                                  source.get("minzoom", 0),
+                                                                  source.get("maxzoom", 22))
+                wmsLayer = QgsRasterLayer(url, layer["id"], "wms")
             else:
-                add = True
-                if layer["source"] not in layers:
-                    add = False
-                    layers[layer["source"]] = dataobjects.load(path, layer["id"])
-                setLayerSymbologyFromMapboxStyle(layers[layer["source"]], layer, sprites, add)
-        elif layerType.lower() == "raster":
-            url = project["sources"][layer["source"]]["tiles"][0]
-            url = url.replace("bbox={bbox-epsg-3857}", "")
-            url = url.replace("&&", "&")
-            wmsLayer = QgsRasterLayer(url, layer["id"], "wms")
+                url = source["tiles"][0]
+                url = url.replace("bbox={bbox-epsg-3857}", "")
+                url = url.replace("&&", "&")
+                wmsLayer = QgsRasterLayer(url, layer["id"], "wms")
+            _setLayerScaleVisibilityFromMapboxStyle(wmsLayer, layer)
             QgsMapLayerRegistry.instance().addMapLayer(wmsLayer)
-    for labelLayer in labels:
-        setLayerLabelingFromMapboxStyle(layers[labelLayer["source"]], labelLayer)
+        else:
+            symbologyStyles = [s for s in styles if not s["id"].startswith("txt")]
+            if sourceType(styles) == "vector":
+                tileSource = tileSources[styles[0]["source"]]
+                styleType = (symbologyStyles or styles)[0]["type"]
+                if tileSource is None or styleType not in _geometryTypes:
+                    continue
+                vectorTileLayer = VectorTileLayer(tileSource, styles[0].get("source-layer"),
+                                                  styleType, (symbologyStyles or styles)[0]["id"])
+                _vectorTileLayers.append(vectorTileLayer)
+                qgisLayer = vectorTileLayer.layer
+            else:
+                result = pending[source]
+                while not result.ready() and not feedback.isCanceled():
+                    QCoreApplication.processEvents()
+                    result.wait(0.05)
+                if feedback.isCanceled():
+                    break
+                qgisLayer = result.get()
+            renderer = None
+            for style in symbologyStyles:
+                renderer = _rendererFromMapboxStyle(qgisLayer, style, sprites, renderer)
+                _setLayerScaleVisibilityFromMapboxStyle(qgisLayer, style)
+            if renderer is not None:
+                qgisLayer.setRendererV2(renderer)
+            for style in styles:
+                if style["id"].startswith("txt"):
+                    setLayerLabelingFromMapboxStyle(qgisLayer, style)
+            QgsMapLayerRegistry.instance().addMapLayer(qgisLayer)
+            if sourceType(styles) == "vector":
+                vectorTileLayer.refresh()
+    if feedback.isCanceled():
+        pool.terminate()
+    else:
+        feedback.setProgress(100)
+    pool.join()
 
 
 def compatibleSymbology(layer):
@@ -987,3 +4047,6 @@ def _checkUnits(symbols, iSymbolLayer, prop):
                    "supported".format(k, iSymbolLayer + 1))
 
     return msg if msg != '' else None
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,22 @@
 var map = olms.apply('map', 'mapbox.json');
+
+// Open the app with '?watch' (served over HTTP) to reload it when
+// mapbox.json changes, for instance while it is kept in sync with
+// QGIS by mapboxgl.ExportWatcher
+if (/[?&]watch\b/.test(window.location.search)) {
+  var lastVersion = null;
+  setInterval(function() {
+    var request = new XMLHttpRequest();
+    request.open('HEAD', 'mapbox.json', true);
+    request.setRequestHeader('Cache-Control', 'no-cache');
+    request.onload = function() {
+      var version = request.getResponseHeader('ETag') ||
+          request.getResponseHeader('Last-Modified') + request.getResponseHeader('Content-Length');
+      if (lastVersion !== null && version !== lastVersion) {
+        window.location.reload();
+      }
+      lastVersion = version;
+    };
+    request.send();
+  }, 500);
+}
@@ -0,0 +1,240 @@
+'''
+Synthetic benchmarks for the export and import pipelines. Run them from the
+QGIS Python console, since the import stage needs the QGIS interface:
+
+    from processing.mapboxgl.tests import benchmarks
+    benchmarks.runBenchmarks("/path/to/results.json")
+
+and compare two runs (for instance, before and after a change) with
+
+    benchmarks.compareBenchmarks("/path/to/before.json", "/path/to/after.json")
+
+The import stage opens each exported file as a new project, which discards
+the current one, so save your work before running them, preferably from an
+empty QGIS session.
+
+Memory is measured by sampling the resident set size of the process while
+each stage runs, which is only available on Linux. It is None elsewhere.
+'''
+
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from processing.mapboxgl import mapboxgl
+from qgis.core import (QgsVectorLayer, QgsFeature, QgsGeometry, QgsPoint, QgsSymbolV2,
+                       QgsSingleSymbolRendererV2, QgsCategorizedSymbolRendererV2,
+                       QgsRendererCategoryV2)
+from PyQt4.QtGui import QColor
+
+GEOMETRY_TYPES = ["Point", "LineString", "Polygon"]
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+CATEGORIES = [1, 10, 100, 1000, 10000]
+SYMBOL_LAYERS = [1, 3]
+# used when sweeping the number of features and the number of categories, respectively
+DEFAULT_CATEGORIES = 10
+DEFAULT_SIZE = 10 ** 4
+BATCH_SIZE = 10000
+STAGES = ["createSources", "_convertSymbologyForLayer", "saveSprites", "openProjectFromMapboxFile"]
+# seconds between samples of the memory used while a stage runs
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+def _syntheticGeometry(geomType, rnd):
+    x, y = rnd.uniform(-180, 179), rnd.uniform(-85, 84)
+    if geomType == "Point":
+        return QgsGeometry.fromPoint(QgsPoint(x, y))
+    elif geomType == "LineString":
+        return QgsGeometry.fromPolyline([QgsPoint(x + i * 0.1, y + rnd.uniform(0, 0.1))
+                                         for i in xrange(4)])
+    else:
+        return QgsGeometry.fromPolygon([[QgsPoint(x, y), QgsPoint(x + 0.1, y),
+                                         QgsPoint(x + 0.1, y + 0.1), QgsPoint(x, y + 0.1),
+                                         QgsPoint(x, y)]])
+
+def syntheticLayer(geomType, size, categories, seed = 0):
+    '''Creates a memory layer with 'size' random features, with a 'cat'
+    attribute that takes 'categories' different values'''
+    layer = QgsVectorLayer("%s?crs=epsg:4326&field=cat:integer&field=name:string(20)" % geomType,
+                           "synthetic_%s_%i" % (geomType.lower(), size), "memory")
+    rnd = random.Random(seed)
+    provider = layer.dataProvider()
+    for start in xrange(0, size, BATCH_SIZE):
+        features = []
+        for i in xrange(start, min(size, start + BATCH_SIZE)):
+            feature = QgsFeature(layer.pendingFields())
+            feature.setGeometry(_syntheticGeometry(geomType, rnd))
+            feature.setAttributes([i % categories, "feature %i" % i])
+            features.append(feature)
+        provider.addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+def _syntheticSymbol(layer, i, symbolLayers):
+    symbol = QgsSymbolV2.defaultSymbol(layer.geometryType())
+    symbol.setColor(QColor.fromHsv(i * 37 % 360, 200, 200))
+    for j in xrange(1, symbolLayers):
+        symbolLayer = symbol.symbolLayer(0).clone()
+        symbolLayer.setColor(QColor.fromHsv((i * 37 + j * 90) % 360, 200, 200))
+        symbol.appendSymbolLayer(symbolLayer)
+    return symbol
+
+def setSyntheticRenderer(layer, categories, symbolLayers):
+    '''Sets a single symbol renderer if 'categories' is 1, or a categorized
+    renderer on the 'cat' attribute otherwise, using symbols with
+    'symbolLayers' symbol layers'''
+    if categories == 1:
+        layer.setRendererV2(QgsSingleSymbolRendererV2(_syntheticSymbol(layer, 0, symbolLayers)))
+    else:
+        cats = [QgsRendererCategoryV2(i, _syntheticSymbol(layer, i, symbolLayers), str(i))
+                for i in xrange(categories)]
+        layer.setRendererV2(QgsCategorizedSymbolRendererV2("cat", cats))
+
+def _rendererSymbols(layer):
+    renderer = layer.rendererV2()
+    if isinstance(renderer, QgsSingleSymbolRendererV2):
+        return renderer.symbol().clone(), None, None
+    symbols = OrderedDict()
+    for cat in renderer.categories():
+        symbols[cat.value()] = cat.symbol().clone()
+    return symbols, "categorical", renderer.classAttribute()
+
+def _currentMemory():
+    # current resident set size of the process, in kilobytes. The peak one
+    # (ru_maxrss) is not used, since it would be the one of the largest
+    # case run so far
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+class _MemorySampler(threading.Thread):
+    '''Samples the resident set size of the process until it is stopped,
+    keeping the maximum value'''
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.peak = _currentMemory()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(MEMORY_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _currentMemory())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, _currentMemory())
+
+def _measure(func, *args):
+    memory = _currentMemory()
+    sampler = None
+    if memory is not None:
+        sampler = _MemorySampler()
+        sampler.start()
+    wall, cpu = time.time(), time.clock()
+    try:
+        result = func(*args)
+    finally:
+        wall, cpu = time.time() - wall, time.clock() - cpu
+        if sampler is not None:
+            sampler.stop()
+    stats = {"wall": wall,
+             "cpu": cpu,
+             "peakMemory": None if sampler is None else sampler.peak,
+             "memoryGrowth": None if sampler is None else sampler.peak - memory}
+    return result, stats
+
+def _folderSize(folder):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, dirs, files in os.walk(folder) for f in files)
+
+def benchmarkLayer(geomType, size, categories, symbolLayers):
+    '''Runs the export and import stages for a synthetic layer and returns
+    the measures of each of them'''
+    layer = syntheticLayer(geomType, size, categories)
+    setSyntheticRenderer(layer, categories, symbolLayers)
+    folder = tempfile.mkdtemp()
+    try:
+        results = OrderedDict()
+        _, results["createSources"] = _measure(mapboxgl.createSources, folder, [layer])
+        results["createSources"]["outputSize"] = _folderSize(os.path.join(folder, "data"))
+        symbols, functionType, attribute = _rendererSymbols(layer)
+        (sprites, _), results["_convertSymbologyForLayer"] = _measure(
+                    mapboxgl._convertSymbologyForLayer, layer, symbols, functionType, attribute)
+        _, results["saveSprites"] = _measure(mapboxgl.saveSprites, folder, sprites)
+        results["saveSprites"]["outputSize"] = sum(os.path.getsize(os.path.join(folder, f))
+                                                  for f in os.listdir(folder)
+                                                  if f.startswith("spriteSheet"))
+        mapboxgl.toMapbox([layer], folder, center=[0, 0], zoom=0)
+        mapboxFile = os.path.join(folder, "mapbox.json")
+        _, results["openProjectFromMapboxFile"] = _measure(mapboxgl.openProjectFromMapboxFile,
+                                                           mapboxFile)
+        results["openProjectFromMapboxFile"]["inputSize"] = _folderSize(folder)
+        for stage in results.values():
+            stage["throughput"] = size / stage["wall"] if stage["wall"] else None
+        return results
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def benchmarkCases(geometryTypes = GEOMETRY_TYPES, sizes = SIZES, categories = CATEGORIES,
+                   symbolLayers = SYMBOL_LAYERS):
+    '''Returns the (geometry type, size, categories, symbol layers) cases to
+    run. The number of features is swept with a fixed number of categories,
+    and the number of categories and symbol layers with a fixed number of
+    features, since running the full product would take days.'''
+    cases = []
+    for geomType in geometryTypes:
+        for size in sizes:
+            cases.append((geomType, size, DEFAULT_CATEGORIES, symbolLayers[0]))
+        for cats in categories:
+            for n in symbolLayers:
+                case = (geomType, DEFAULT_SIZE, cats, n)
+                if case not in cases:
+                    cases.append(case)
+    return cases
+
+def runBenchmarks(outputFile, cases = None, version = None):
+    '''Runs the benchmarks and saves the results to 'outputFile' as JSON.
+    The current QGIS project is discarded, since the import stage opens
+    the exported files as new projects'''
+    results = []
+    for geomType, size, categories, symbolLayers in cases or benchmarkCases():
+        results.append({"geometryType": geomType,
+                        "size": size,
+                        "categories": categories,
+                        "symbolLayers": symbolLayers,
+                        "stages": benchmarkLayer(geomType, size, categories, symbolLayers)})
+    obj = {"version": version, "timestamp": time.time(), "results": results}
+    with open(outputFile, "w") as f:
+        json.dump(obj, f, indent=2)
+    return obj
+
+def _caseKey(result):
+    return (result["geometryType"], result["size"], result["categories"], result["symbolLayers"])
+
+def compareBenchmarks(baselineFile, currentFile, tolerance = 0.1):
+    '''Compares two benchmark results files and returns the stages whose wall
+    time grew more than 'tolerance' (as a fraction of the baseline time)'''
+    with open(baselineFile) as f:
+        baseline = {_caseKey(r): r["stages"] for r in json.load(f)["results"]}
+    with open(currentFile) as f:
+        current = {_caseKey(r): r["stages"] for r in json.load(f)["results"]}
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        for stage in STAGES:
+            before = baseline[key].get(stage, {}).get("wall")
+            after = current[key].get(stage, {}).get("wall")
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(key + (stage, before, after))
+    for regression in regressions:
+        print "%s, %i features, %i categories, %i symbol layers: %s %.3fs -> %.3fs" % regression
+    return regressions
@@ -1,15 +1,23 @@
 import unittest
 import sys
+import io
+import json
+import zlib
 from processing.mapboxgl import mapboxgl
 from qgis.utils import iface
 import os
-from qgis.core import QgsMapLayerRegistry
+from qgis.core import (QgsMapLayerRegistry, QgsPalLayerSettings, QgsPoint, QgsVectorLayer,
+                       QgsFeature, QgsGeometry, QgsSymbolV2, QgsCategorizedSymbolRendererV2,
+                       QgsRendererCategoryV2, QgsSingleSymbolRendererV2,
+                       QgsCoordinateReferenceSystem)
 import shutil
 import processing
 from processing import dataobjects
 import tempfile
 import webbrowser
 from distutils.dir_util import copy_tree
+from collections import OrderedDict
+from PyQt4.QtCore import QVariant
 
 def testRoundTripPoints():
     projectFile = os.path.join(os.path.dirname(__file__), "data", "testpoints.qgs")
@@ -59,6 +67,87 @@ def testRoundTripLines():
     mapboxgl.setLayerSymbologyFromMapboxStyle(layerC2, styles["layers"][2])
     shutil.rmtree(folder, ignore_errors=True)
 
+def testRoundTripLabelOffset():
+    projectFile = os.path.join(os.path.dirname(__file__), "data", "testpoints.qgs")
+    iface.addProject(projectFile)
+    layerA = processing.getObject("points")
+    layerA.setCustomProperty("labeling/fieldName", "name")
+    layerA.setCustomProperty("labeling/xOffset", 2.5)
+    layerA.setCustomProperty("labeling/yOffset", -4)
+    style = mapboxgl.processLabeling(layerA)
+    assert style["layout"]["text-offset"] == [2.5, -4]
+    layerA2 = dataobjects.load(layerA.source(), "points2")
+    mapboxgl.setLayerLabelingFromMapboxStyle(layerA2, style)
+    palyr = QgsPalLayerSettings()
+    palyr.readFromLayer(layerA2)
+    assert (palyr.xOffset, palyr.yOffset) == (2.5, -4)
+
+def _pointLayer(fields, rows):
+    layer = QgsVectorLayer("Point?crs=epsg:4326&%s" % "&".join("field=%s" % f for f in fields),
+                           "test", "memory")
+    features = []
+    for i, values in enumerate(rows):
+        feature = QgsFeature(layer.pendingFields())
+        feature.setGeometry(QgsGeometry.fromPoint(QgsPoint(i, i)))
+        feature.setAttributes(values)
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+def _exportedProperties(folder, layer):
+    with open(os.path.join(folder, "data", "%s.geojson" % mapboxgl.safeName(layer.name()))) as f:
+        return [feature["properties"] for feature in json.load(f)["features"]]
+
+def testEncodeCategories():
+    layer = _pointLayer(["tags:string", "cls:string"],
+                        [[u'["a]b"]', "x"], ['{"cls":"y"}', "y"], ["", "z"]])
+    categories = [QgsRendererCategoryV2(v, QgsSymbolV2.defaultSymbol(layer.geometryType()), v)
+                  for v in ["x", "y"]]
+    layer.setRendererV2(QgsCategorizedSymbolRendererV2("cls", categories))
+    folder = tempfile.mkdtemp()
+    try:
+        mapboxgl.createSources(folder, [layer], encodeCategories=True)
+        properties = _exportedProperties(folder, layer)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    assert [p["cls"] for p in properties] == [0, 1, None]
+    assert [p["tags"] for p in properties] == [u'["a]b"]', '{"cls":"y"}', ""]
+
+def testLabelCodepoints():
+    layer = _pointLayer(["name:string", "cls:string"],
+                        [[u"caf\u00e9", "x"], [None, "y"], [u"\u00e9t\u00e9", "x"]])
+    layer.setCustomProperty("labeling/enabled", "true")
+    layer.setCustomProperty("labeling/fieldName", "name")
+    layer.setCustomProperty("labeling/fontFamily", "Arial")
+    layer.setCustomProperty("labeling/fontBold", "true")
+    folder = tempfile.mkdtemp()
+    codepoints = {}
+    try:
+        mapboxgl.createSources(folder, [layer], codepoints=codepoints)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    assert codepoints == {"Arial Bold": set(ord(c) for c in u"caf\u00e9t")}
+
+def testLayerStatisticsSample():
+    layer = QgsVectorLayer("LineString?crs=epsg:4326", "lines", "memory")
+    features = []
+    for y, step, count in [(0, 0.001, 15000), (1, 0.002, 20000)]:
+        feature = QgsFeature(layer.pendingFields())
+        feature.setGeometry(QgsGeometry.fromPolyline([QgsPoint(i * step, y)
+                                                      for i in xrange(count + 1)]))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    statistics = mapboxgl._LayerStatistics(layer)
+    for feature in layer.getFeatures():
+        statistics.add(feature)
+    result = statistics.result()
+    assert (result["features"], result["vertices"]) == (2, 35002)
+    assert len(statistics.segments) <= mapboxgl.MAX_SEGMENT_SAMPLES
+    # the segments of the second feature are the majority, so they must be sampled as well
+    assert abs(result["segment"] - 0.002) < 1e-9
+
 def _testOLApp(project):
     projectFile = os.path.join(os.path.dirname(__file__), "data", "%s.qgs" % project)
     iface.addProject(projectFile)
@@ -75,4 +164,291 @@ def testLinesInOLApp():
 
 
 def testPOlygonsInOLApp():
-    _testOLApp("testpolygons")
\ No newline at end of file
+    _testOLApp("testpolygons")
+
+# modules only needed by some entry points, which are imported when used
+LAZY_MODULES = ["sqlite3", "multiprocessing", "multiprocessing.pool", "argparse",
+                "xml.etree.ElementTree", "BaseHTTPServer"]
+# a generous limit for the import time, which only catches heavy work done
+# at import time, and not the variations between machines
+IMPORT_TIME_THRESHOLD = 5
+
+def testImportTime():
+    import imp
+    import time
+    path = os.path.splitext(mapboxgl.__file__)[0] + ".py"
+    loaded = set(sys.modules)
+    start = time.time()
+    module = imp.load_source("mapboxgl_importtime", path)
+    elapsed = time.time() - start
+    imported = [name for name in LAZY_MODULES if name in set(sys.modules) - loaded]
+    assert not imported, "Importing mapboxgl imports %s" % ", ".join(imported)
+    for name in ["sqlite3", "multiprocessing", "argparse", "ElementTree", "ThreadPool", "BaseHTTPServer"]:
+        assert not hasattr(module, name), "%s is imported at module import time" % name
+    assert elapsed < IMPORT_TIME_THRESHOLD, "Importing mapboxgl took %.3f seconds" % elapsed
+
+# documents with strings, escapes, numbers and nested values, to split at
+# every possible chunk boundary
+JSON_STREAM_DOCUMENTS = [
+    u'{"a": "x\\"y,\\\\}", "b": [1, -2.5e-3, 1.25E+10, 0, true, false, null], '
+    u'"c": {"d": {"e": []}, "f": {}}, "g": "\\u00e9\\n\\t", "h": 123456789, "i": "caf\u00e9 ]}"}',
+    u'[[[]], [{"a": [1.5]}], -0.5, 1e5, "", "\\/", {"": ","}]',
+    u' { "x" : 12.75 , "y" : [ 3 , 4 ] } ']
+
+def _walkJson(reader):
+    char = reader.peek()
+    if char == u"{":
+        return dict((key, _walkJson(reader)) for key in reader.keys())
+    elif char == u"[":
+        return [_walkJson(reader) for _ in reader.elements()]
+    return reader.value()
+
+def testJsonStreamReaderChunkBoundaries():
+    for doc in JSON_STREAM_DOCUMENTS:
+        expected = json.loads(doc)
+        for chunkSize in xrange(1, len(doc) + 1):
+            reader = mapboxgl._JsonStreamReader(io.StringIO(doc), chunkSize)
+            assert _walkJson(reader) == expected, "Chunk size %i: %s" % (chunkSize, doc)
+            reader = mapboxgl._JsonStreamReader(io.StringIO(doc), chunkSize)
+            assert reader.value() == expected, "Chunk size %i: %s" % (chunkSize, doc)
+
+TILE_RING = [(0, 0), (4096, 0), (4096, 4096), (0, 4096), (0, 0)]
+TILE_HOLE = [(1024, 1024), (1024, 3072), (3072, 3072), (3072, 1024), (1024, 1024)]
+
+def testVectorTileGeometryRoundTrip():
+    points = [[(10, 20)], [(-5, 4100)]]
+    lines = [[(0, 0), (100, 50), (100, 4000)], [(5, 5), (6, 7)]]
+    polygons = [[TILE_RING, TILE_HOLE], [[(5000, 5000), (6000, 5000), (6000, 6000), (5000, 5000)]]]
+    for geomType, parts in [(1, points), (2, lines), (3, polygons)]:
+        commands = mapboxgl._encodeTileGeometry(geomType, parts)
+        assert mapboxgl._decodeTileGeometry(geomType, commands) == parts, geomType
+
+def testVectorTileRingOrientation():
+    # rings with the wrong orientation are reversed, so holes are kept
+    commands = mapboxgl._encodeTileGeometry(3, [[TILE_RING[::-1], TILE_HOLE[::-1]]])
+    polygons = mapboxgl._decodeTileGeometry(3, commands)
+    assert len(polygons) == 1 and len(polygons[0]) == 2
+    exterior, hole = polygons[0]
+    assert mapboxgl._ringArea(exterior) > 0 and set(exterior) == set(TILE_RING)
+    assert mapboxgl._ringArea(hole) < 0 and set(hole) == set(TILE_HOLE)
+
+def testVectorTileRoundTrip():
+    properties = {"name": u"caf\u00e9", "count": 5, "negative": -3, "ratio": 1.5, "visible": True}
+    data = mapboxgl._encodeVectorTile([("points", [(1, 1, [[(2048, 2048)]], properties)]),
+                                       ("polygons", [(2, 3, [[TILE_RING, TILE_HOLE]], {})])])
+    layers = mapboxgl._decodeVectorTile(mapboxgl._gzip(data), 0, 0, 0)
+    assert sorted(layers) == ["points", "polygons"]
+    [(geomType, wkt, decodedProperties)] = layers["points"]
+    assert (geomType, wkt, decodedProperties) == (1, "MULTIPOINT((0.0000000 0.0000000))", properties)
+    [(geomType, wkt, decodedProperties)] = layers["polygons"]
+    assert geomType == 3 and decodedProperties == {}
+    assert wkt.startswith("MULTIPOLYGON(((") and wkt.count("),(") == 1, wkt
+
+class _TileServerRequest(object):
+    '''Records the response of a TileServer to a GET request'''
+
+    def __init__(self, path, headers = None):
+        self.path = path
+        self.headers = headers or {}
+        self.status = None
+        self.responseHeaders = {}
+        self.wfile = io.BytesIO()
+
+    def send_response(self, status):
+        self.status = status
+
+    def send_error(self, status):
+        self.status = status
+
+    def send_header(self, name, value):
+        self.responseHeaders[name] = value
+
+    def end_headers(self):
+        pass
+
+def testVectorTilePropertyTypes():
+    types = mapboxgl._propertyTypes([{"a": 1, "b": 2.5, "c": "x"}, {"a": 3, "b": "4"}, {"c": 5}])
+    assert types == {"a": QVariant.Double, "b": QVariant.String, "c": QVariant.String}
+
+def _testTileServer():
+    server = mapboxgl.TileServer(maxzoom = 5)
+    server.style = {"version": 8, "sources": {"qgis": {"type": "vector", "maxzoom": 5}}, "layers": []}
+    server.files = {"spriteSheet.json": "{}"}
+    return server
+
+def _tileServerGet(server, path, headers = None):
+    request = _TileServerRequest(path, headers)
+    server._handle(request)
+    return request
+
+def testTileServerGzip():
+    server = _testTileServer()
+    gzipped = _tileServerGet(server, "/tiles/1/0/1.pbf", {"Accept-Encoding": "gzip, deflate"})
+    assert gzipped.status == 200
+    assert gzipped.responseHeaders["Content-Type"] == "application/x-protobuf"
+    assert gzipped.responseHeaders["Content-Encoding"] == "gzip"
+    assert mapboxgl._decodeVectorTile(gzipped.wfile.getvalue(), 1, 0, 1) == {}
+    plain = _tileServerGet(server, "/tiles/1/0/1.pbf")
+    assert plain.status == 200 and "Content-Encoding" not in plain.responseHeaders
+    assert plain.wfile.getvalue() == zlib.decompress(gzipped.wfile.getvalue(), 16 + zlib.MAX_WBITS)
+    style = _tileServerGet(server, "/mapbox.json", {"Accept-Encoding": "gzip", "Host": "localhost:9000"})
+    assert style.responseHeaders["Content-Encoding"] == "gzip"
+    style = json.loads(zlib.decompress(style.wfile.getvalue(), 16 + zlib.MAX_WBITS))
+    assert style["sources"]["qgis"]["tiles"] == ["http://localhost:9000/tiles/{z}/{x}/{y}.pbf"]
+
+def testTileServerETag():
+    server = _testTileServer()
+    first = _tileServerGet(server, "/spriteSheet.json")
+    etag = first.responseHeaders["ETag"]
+    second = _tileServerGet(server, "/spriteSheet.json", {"If-None-Match": etag})
+    assert second.status == 304 and second.wfile.getvalue() == ""
+    assert second.responseHeaders["ETag"] == etag
+    server.files = {"spriteSheet.json": '{"a": 1}'}
+    third = _tileServerGet(server, "/spriteSheet.json", {"If-None-Match": etag})
+    assert third.status == 200 and third.responseHeaders["ETag"] != etag
+
+def testTileServerOutOfRange():
+    server = _testTileServer()
+    for path in ["/tiles/6/0/0.pbf", "/tiles/1/2/0.pbf", "/tiles/1/0/2.pbf", "/unknown.js", "/../tests.py"]:
+        assert _tileServerGet(server, path).status == 404, path
+    assert _tileServerGet(server, "/tiles/5/31/31.pbf").status == 200
+
+def testHilbertIndex():
+    order = 3
+    cells = {}
+    for x in xrange(1 << order):
+        for y in xrange(1 << order):
+            cells[mapboxgl._hilbertIndex(x, y, order)] = (x, y)
+    # every cell has a different position, covering the whole curve
+    assert sorted(cells) == range(1 << (2 * order))
+    # consecutive positions are neighbour cells
+    for i in xrange(len(cells) - 1):
+        (x0, y0), (x1, y1) = cells[i], cells[i + 1]
+        assert abs(x0 - x1) + abs(y0 - y1) == 1, (cells[i], cells[i + 1])
+
+def _geojsonLines(features):
+    # lines of a GeoJSON file rewritten by createSources, one feature per line
+    lines = [json.dumps(f, separators=(",", ":")) + "," for f in features]
+    lines[-1] = lines[-1].rstrip(",")
+    return ['{', '"type":"FeatureCollection",', '"features":['] + lines + [']', '}']
+
+def testHilbertSorted():
+    features = [OrderedDict([("type", "Feature"), ("properties", {"id": i}), ("geometry", geometry)])
+                for i, geometry in enumerate([
+                    {"type": "Point", "coordinates": [10, 10]},
+                    None,
+                    {"type": "Point", "coordinates": [0, 0]},
+                    {"type": "LineString", "coordinates": [[0, 9], [1, 10]]},
+                    {"type": "Polygon", "coordinates": [[[9, 0], [10, 0], [10, 1], [9, 0]]]},
+                    {"type": "Point", "coordinates": [0.5, 0.5]}])]
+    lines = _geojsonLines(features)
+    sortedLines = mapboxgl._hilbertSorted(lines)
+    assert sortedLines[:3] == lines[:3] and sortedLines[-2:] == lines[-2:]
+    collection = json.loads("".join(sortedLines))
+    ids = [f["properties"]["id"] for f in collection["features"]]
+    assert sorted(ids) == range(len(features))
+    # close features stay together, and features without geometry go last
+    assert ids[-1] == 1 and abs(ids.index(2) - ids.index(5)) == 1, ids
+    byId = dict((f["properties"]["id"], f) for f in collection["features"])
+    assert [byId[i] for i in xrange(len(features))] == features
+
+def testFeatureBoundsCenter():
+    properties = OrderedDict([("coordinates", [500, 500]), ("geometry", "[600, 600]")])
+    line = _geojsonLines([OrderedDict([("type", "Feature"), ("properties", properties),
+                                       ("geometry", {"type": "Point", "coordinates": [1, 2]})])])[3]
+    assert mapboxgl._featureBoundsCenter(line) == (1.0, 2.0)
+    line = _geojsonLines([OrderedDict([("type", "Feature"), ("properties", properties),
+                                       ("geometry", None)])])[3]
+    assert mapboxgl._featureBoundsCenter(line) is None
+
+def testPoleOfInaccessibility():
+    square = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+    x, y = mapboxgl._poleOfInaccessibility([square])
+    assert abs(x - 5) <= 0.1 and abs(y - 5) <= 0.1, (x, y)
+    # in a U shape the centroid is outside the polygon, but the pole is not
+    u = [(0, 0), (10, 0), (10, 10), (7, 10), (7, 3), (3, 3), (3, 10), (0, 10), (0, 0)]
+    x, y = mapboxgl._poleOfInaccessibility([u])
+    assert mapboxgl._pointToPolygonDistance(x, y, [u]) >= 1.4, (x, y)
+    # and it is not placed in a hole
+    hole = [(2, 2), (2, 8), (8, 8), (8, 2), (2, 2)]
+    x, y = mapboxgl._poleOfInaccessibility([square, hole])
+    assert mapboxgl._pointToPolygonDistance(x, y, [square, hole]) >= 0.9, (x, y)
+    assert mapboxgl._poleOfInaccessibility([[(0, 0), (1, 1)]]) is None
+
+def _mergedCoordinates(lines):
+    lines = [[QgsPoint(x, y) for x, y in line] for line in lines]
+    return [[(p.x(), p.y()) for p in line] for line in mapboxgl._mergeLines(lines)]
+
+def testMergeLines():
+    a, b, c, d = (0, 0), (1, 0), (2, 0), (1, 1)
+    assert _mergedCoordinates([[a, b], [b, c]]) == [[a, b, c]]
+    # lines are reversed when needed, and merged in both directions
+    assert _mergedCoordinates([[a, b], [c, b]]) == [[a, b, c]]
+    assert _mergedCoordinates([[b, c], [a, b]]) == [[a, b, c]]
+    # lines are not merged at points shared by more than two lines
+    assert _mergedCoordinates([[a, b], [b, c], [b, d]]) == [[a, b], [b, c], [b, d]]
+    assert _mergedCoordinates([[a, b], [b, d], [d, a]]) == [[a, b, d, a]]
+    assert _mergedCoordinates([[a, b], [c, d]]) == [[a, b], [c, d]]
+
+def _square(x, y):
+    return QgsGeometry.fromPolygon([[QgsPoint(x, y), QgsPoint(x + 1, y), QgsPoint(x + 1, y + 1),
+                                     QgsPoint(x, y + 1), QgsPoint(x, y)]])
+
+def testDissolvePolygons():
+    crs = QgsCoordinateReferenceSystem()
+    crs.createFromProj4("+proj=merc +lon_0=10 +x_0=100 +units=m +no_defs")
+    layer = QgsVectorLayer("Polygon?crs=epsg:4326", "polygons", "memory")
+    layer.setCrs(crs)
+    features = []
+    # the first two squares are adjacent, and the third one does not touch them
+    for x in [0, 1, 5]:
+        feature = QgsFeature(layer.pendingFields())
+        feature.setGeometry(_square(x, 0))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.setRendererV2(QgsSingleSymbolRendererV2(QgsSymbolV2.defaultSymbol(layer.geometryType())))
+    dissolved = mapboxgl._dissolvedLayer(layer)
+    assert dissolved.crs().toProj4() == crs.toProj4()
+    areas = sorted(f.geometry().area() for f in dissolved.getFeatures())
+    assert [round(a, 6) for a in areas] == [1, 2], areas
+
+def testGlyphSdf():
+    w, h = 16, 16
+    # a 6x6 opaque square in the middle of the image
+    alpha = [[1.0 if 5 <= x < 11 and 5 <= y < 11 else 0.0 for x in xrange(w)] for y in xrange(h)]
+    sdf = bytearray(mapboxgl._sdf(alpha, w, h))
+    assert len(sdf) == w * h
+    value = lambda x, y: sdf[y * w + x]
+    edge = 255 * (1 - mapboxgl.GLYPH_CUTOFF)
+    # values grow towards the inside of the glyph, and cross the cutoff
+    # value at its edge
+    assert value(0, 0) < value(3, 3) < value(5, 5) < value(7, 7)
+    assert value(4, 8) < edge < value(5, 8)
+    assert value(10, 8) > edge > value(11, 8)
+
+def _glyphMessages(data):
+    # returns the name and range of a glyphs PBF file, and its glyphs as dicts
+    [(field, fontstack)] = list(mapboxgl._pbfFields(data))
+    assert field == 1
+    name = rangeName = None
+    glyphs = []
+    for field, value in mapboxgl._pbfFields(fontstack):
+        if field == 1:
+            name = value
+        elif field == 2:
+            rangeName = value
+        elif field == 3:
+            glyphs.append(dict(mapboxgl._pbfFields(value)))
+    return name, rangeName, glyphs
+
+def testGlyphPbf():
+    sink = mapboxgl._MemorySink()
+    mapboxgl.saveGlyphs(sink, [], {"Arial Regular": set([ord("A"), ord(" "), 0x263a])})
+    assert sorted(sink.files) == ["glyphs/Arial Regular/0-255.pbf", "glyphs/Arial Regular/9728-9983.pbf"]
+    name, rangeName, glyphs = _glyphMessages(sink.files["glyphs/Arial Regular/0-255.pbf"])
+    assert (name, rangeName) == ("Arial Regular", "0-255")
+    space, a = glyphs
+    assert space[1] == ord(" ") and 2 not in space and space[3] == space[4] == 0 and space[7] > 0
+    assert a[1] == ord("A") and a[3] > 0 and a[4] > 0 and a[7] > 0
+    buffer = mapboxgl.GLYPH_BUFFER
+    assert len(a[2]) == (a[3] + 2 * buffer) * (a[4] + 2 * buffer)
@@ -1,7 +1,33 @@
 # -*- coding: utf-8 -*-
 
-import mapboxgl
-from PyQt4 import QtGui
+from PyQt4 import QtGui, QtCore
+
+# mapboxgl is imported when an import or export is run, not when the plugin
+# is loaded, so it does not slow down QGIS startup
+
+class ProgressDialogFeedback(object):
+    """Same interface as mapboxgl.Feedback, showing progress in a dialog"""
+
+    def __init__(self, title, parent):
+        self._canceled = False
+        self.dialog = QtGui.QProgressDialog(title, "Cancel", 0, 100, parent)
+        self.dialog.setWindowModality(QtCore.Qt.WindowModal)
+        self.dialog.canceled.connect(self.cancel)
+        self.dialog.show()
+
+    def setProgress(self, percentage, text = None):
+        self.dialog.setValue(percentage)
+        if text is not None:
+            self.dialog.setLabelText(text)
+
+    def isCanceled(self):
+        return self._canceled
+
+    def cancel(self):
+        self._canceled = True
+
+    def close(self):
+        self.dialog.close()
 
 class MapboxGLPlugin:
 
@@ -28,11 +54,33 @@ class MapboxGLPlugin:
     def importMapbox(self):
         filename = QtGui.QFileDialog.getOpenFileName(self.iface.mainWindow(), 'Open Mapbox File')
         if filename:
-            mapboxgl.openProjectFromMapboxFile(filename)
+            import mapboxgl
+            feedback = ProgressDialogFeedback("Importing Mapbox GL file...", self.iface.mainWindow())
+            try:
+                mapboxgl.openProjectFromMapboxFile(filename, feedback)
+            finally:
+                feedback.close()
         
     def exportMapbox(self, includeApp):
         folder =  QtGui.QFileDialog.getExistingDirectory(self.iface.mainWindow(), "Select folder to store project", 
                                                         "", QtGui.QFileDialog.ShowDirsOnly)
         if folder:
-            mapboxgl.projectToMapbox(folder, includeApp)
+            import mapboxgl
+            feedback = ProgressDialogFeedback("Exporting Mapbox GL file...", self.iface.mainWindow())
+            self.exportThread = mapboxgl.ExportThread(mapboxgl.qgisLayers(), folder, includeApp, feedback)
+            self.exportThread.progressChanged.connect(feedback.setProgress)
+            self.exportThread.finished.connect(lambda: self.exportFinished(feedback))
+            self.exportThread.start()
+
+    def exportFinished(self, feedback):
+        feedback.close()
+        thread = self.exportThread
+        self.exportThread = None
+        if thread.error is not None:
+            QtGui.QMessageBox.warning(self.iface.mainWindow(), "Export Mapbox GL",
+                                      "The export could not be completed:\n" + thread.error)
+        elif thread.canceled:
+            self.iface.messageBar().pushMessage("Mapbox GL", "Export canceled")
+        else:
+            self.iface.messageBar().pushMessage("Mapbox GL", "Project exported to " + thread.folder)
     
\ No newline at end of file